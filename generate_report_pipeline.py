@@ -1,11 +1,28 @@
-from prefect import flow
+from prefect import flow, task
 
-from superset_client import generate_report_pipe
+from superset_client import update_report_charts, summarize_visits, publish_report
+
+
+@task(retries=1, retry_delay_seconds=30)
+def update_charts(company):
+    update_report_charts(company)
+
+
+@task(retries=1, retry_delay_seconds=30)
+def summarize(company, start_date, end_date):
+    return summarize_visits(company, start_date, end_date)
+
+
+@task
+def publish(company, summary, start_date, end_date, report_name):
+    publish_report(company, summary, start_date, end_date, report_name)
 
 
 @flow
 def fluxo_principal(company, start_date, end_date, report_name):
-    generate_report_pipe(company, start_date, end_date, report_name)
+    charts = update_charts.submit(company)
+    summary = summarize.submit(company, start_date, end_date)
+    publish(company, summary, start_date, end_date, report_name, wait_for=[charts])
 
 
 if __name__ == "__main__":
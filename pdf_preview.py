@@ -0,0 +1,20 @@
+import fitz
+import numpy as np
+
+
+def render_page(pdf_content: bytes, page_num: int, zoom: float = 2, allow_repair: bool = True) -> tuple:
+    """Rasteriza uma página do PDF como array RGB (altura x largura x 3).
+
+    Abre o documento uma única vez e retorna (imagem, total de páginas);
+    a imagem é None quando a página não existe. Com allow_repair=False,
+    um documento que o MuPDF precisou reparar (ex.: download parcial com
+    objetos faltando) também retorna (None, 0).
+    """
+    with fitz.open(stream=pdf_content, filetype="pdf") as pdf_document:
+        total_pages = len(pdf_document)
+        if not 0 <= page_num < total_pages:
+            return None, total_pages
+        pix = pdf_document[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+        if not allow_repair and pdf_document.is_repaired:
+            return None, 0
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n), total_pages
@@ -1,20 +1,38 @@
+import asyncio
+import atexit
+import base64
+import io
 import json
 import os
+import queue
+import random
+import re
+import select
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from threading import Thread
+from threading import Lock, Thread
 
 import bcrypt
 import boto3
-import fitz  # PyMuPDF para preview de PDF
+import httpx
+import orjson
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import psycopg2
 import requests
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import streamlit as st
+from botocore.config import Config
+from cachetools import TTLCache
 from botocore.exceptions import ClientError
+from streamlit.errors import StreamlitAPIException
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from websockets.asyncio.client import connect as ws_connect
 
 load_dotenv()
 
@@ -23,33 +41,60 @@ load_dotenv()
 # ============================================================================
 
 # Rate Limiting para Login
-if 'LOGIN_ATTEMPTS' not in st.session_state:
-    st.session_state['LOGIN_ATTEMPTS'] = {}
-LOGIN_ATTEMPTS = st.session_state['LOGIN_ATTEMPTS']
 MAX_LOGIN_ATTEMPTS = 5
 LOCKOUT_DURATION = 300  # 5 minutos em segundos
 
+
+@st.cache_resource
+def get_login_attempts_store() -> tuple:
+    """Tentativas de login compartilhadas por todas as sessões do processo (e não por sessão do navegador)"""
+    return TTLCache(maxsize=10_000, ttl=LOCKOUT_DURATION), Lock()
+
+
+LOGIN_ATTEMPTS, LOGIN_ATTEMPTS_LOCK = get_login_attempts_store()
+
+# Validação de email
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# Custo do bcrypt (12 ≈ 250 ms por hash; cada unidade a menos divide o tempo por 2)
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+
 # Configuração do Banco de Dados
 DB_CONFIG = {
     'dbname': os.getenv('POSTGRES_DB_PORTAL', 'portal'),
     'user': os.getenv('POSTGRES_USER'),
     'password': os.getenv('POSTGRES_PASSWORD'),
     'host': os.getenv('POSTGRES_HOST'),
-    'port': os.getenv('POSTGRES_PORT', '5432')
+    'port': os.getenv('POSTGRES_PORT', '5432'),
+    # Detecta conexões mortas mantidas abertas no pool e no LISTEN
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3
 }
 
 # Validação de credenciais obrigatórias
 if not all([DB_CONFIG['user'], DB_CONFIG['password']]):
     raise ValueError("POSTGRES_USER e POSTGRES_PASSWORD devem estar definidos nas variáveis de ambiente")
 
+# Pool de conexões com o Postgres
+DB_POOL_MIN_CONN = int(os.getenv('DB_POOL_MIN_CONN', '2'))
+DB_POOL_MAX_CONN = int(os.getenv('DB_POOL_MAX_CONN', '20'))
+
 # Configuração do Prefect
 PREFECT_API_URL = os.getenv('PREFECT_API_URL')
 PREFECT_USERNAME = os.getenv('PREFECT_USERNAME')
 PREFECT_PASSWORD = os.getenv('PREFECT_PASSWORD')
+PREFECT_FLOW_ID = os.getenv('PREFECT_FLOW_ID')
+PREFECT_DEPLOYMENT_ID = os.getenv('PREFECT_DEPLOYMENT_ID')
+PREFECT_WORK_POOL = os.getenv('PREFECT_WORK_POOL', 'lm')
 
 if not all([PREFECT_API_URL, PREFECT_USERNAME, PREFECT_PASSWORD]):
     raise ValueError("Variáveis de ambiente do Prefect não configuradas corretamente")
 
+# Stream de eventos do Prefect (websocket) usado para receber mudanças de estado
+PREFECT_EVENTS_URL = re.sub(r'^http', 'ws', PREFECT_API_URL.rstrip('/')) + '/events/out'
+
 # Configuração do S3/MinIO
 MINIO_ENDPOINT = os.getenv('MINIO_ENDPOINT')
 S3_BUCKET = os.getenv('MINIO_BUCKET')
@@ -62,6 +107,70 @@ if not all([MINIO_ENDPOINT, S3_BUCKET, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY]
 
 # Configurações de paginação
 ITEMS_PER_PAGE = 10
+AUDIT_LOGS_PER_PAGE = 100
+
+# Gravação de auditoria em segundo plano
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 2  # segundos que o writer espera para juntar registros
+AUDIT_SHUTDOWN_TIMEOUT = 10  # segundos que o encerramento espera o writer esvaziar a fila
+
+# Configurações do polling de status dos flows
+POLLING_INTERVAL = 5  # segundos
+POLLING_TIMEOUT = 600 * POLLING_INTERVAL  # segundos desde a criação do relatório
+PREFECT_FILTER_LIMIT = 200  # limite padrão de itens por consulta na API do Prefect
+PREFECT_MAX_CONCURRENT_REQUESTS = 32  # requisições simultâneas ao Prefect a partir do event loop
+POLLING_DB_WORKERS = 4  # threads do event loop de polling para acesso ao banco
+POLLING_MIN_INTERVAL = 1  # intervalo logo após uma mudança de estado
+POLLING_MAX_INTERVAL = 30  # teto do backoff exponencial
+POLLING_FALLBACK_INTERVAL = 60  # teto enquanto o stream de eventos está conectado
+POLLING_JITTER = 0.5  # segundos aleatórios somados a cada espera
+
+# Tempo (segundos) em que as listas de empresas/usuários ficam em cache
+LOOKUP_CACHE_TTL = 300
+
+# Tempo (segundos) em que as estatísticas do dashboard ficam em cache
+DASHBOARD_STATS_TTL = 20
+
+# Intervalo (segundos) de atualização das materialized views do dashboard
+DASHBOARD_VIEWS_REFRESH = 60
+
+# Chave do advisory lock que garante um único processo atualizando as views
+DASHBOARD_VIEWS_LOCK_ID = 746001
+
+# Status de relatório que não mudam mais
+FINAL_REPORT_STATUSES = ('completed', 'failed', 'cancelled', 'timeout')
+
+# Opções fixas dos seletores
+REPORT_STATUS_FILTERS = ("Todos", "pending", "scheduled", "running", "completed", "failed", "timeout")
+AUDIT_ACTIONS = ("login", "logout", "generate_report", "download_report",
+                 "add_company", "add_user", "delete_report")
+USER_ROLES = ("admin", "user", "viewer")
+
+# Status com ícone exibidos na listagem de relatórios
+STATUS_LABELS = {
+    'pending': '⏳ pending', 'scheduled': '📅 scheduled', 'running': '⚙️ running',
+    'completed': '✅ completed', 'failed': '❌ failed', 'timeout': '⏰ timeout'
+}
+
+# Estados do Prefect -> status do relatório
+PREFECT_STATUS_MAP = {
+    'SCHEDULED': 'scheduled', 'PENDING': 'pending',
+    'RUNNING': 'running', 'COMPLETED': 'completed',
+    'FAILED': 'failed', 'CANCELLED': 'cancelled',
+    'CRASHED': 'failed'
+}
+PREFECT_FINAL_STATES = frozenset(('COMPLETED', 'FAILED', 'CANCELLED', 'CRASHED'))
+
+# Janelas de download parcial usadas no preview de PDF
+PREVIEW_HEAD_BYTES = 2 * 1024 * 1024  # início do arquivo (primeiras páginas)
+PREVIEW_TAIL_BYTES = 64 * 1024  # fim do arquivo (xref/trailer)
+S3_HEAD_CACHE_TTL = 30  # segundos em que o resultado de um HEAD no S3 é reaproveitado
+REPORT_BYTES_CACHE_ENTRIES = 16  # PDFs completos mantidos em memória para download
+
+# Download paralelo em partes (range GET) para arquivos grandes
+PARALLEL_DOWNLOAD_THRESHOLD = 16 * 1024 * 1024
+PARALLEL_DOWNLOAD_CHUNK = 8 * 1024 * 1024
+PARALLEL_DOWNLOAD_WORKERS = 8
 
 
 # ============================================================================
@@ -69,7 +178,13 @@ ITEMS_PER_PAGE = 10
 # ============================================================================
 
 def hash_password(password: str) -> bytes:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+@st.cache_resource
+def get_hash_executor() -> ThreadPoolExecutor:
+    """Threads que calculam hashes bcrypt, limitando quantos rodam ao mesmo tempo"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='bcrypt')
 
 
 def verify_password(password: str, hashed) -> bool:
@@ -91,13 +206,11 @@ def verify_password(password: str, hashed) -> bool:
 def check_rate_limit(identifier: str) -> tuple[bool, int]:
     current_time = time.time()
 
-    if identifier not in LOGIN_ATTEMPTS:
-        return True, 0
-
-    attempt_data = LOGIN_ATTEMPTS[identifier]
+    # Entradas expiram sozinhas após LOCKOUT_DURATION desde a última falha (TTLCache)
+    with LOGIN_ATTEMPTS_LOCK:
+        attempt_data = LOGIN_ATTEMPTS.get(identifier)
 
-    if current_time - attempt_data['timestamp'] > LOCKOUT_DURATION:
-        del LOGIN_ATTEMPTS[identifier]
+    if attempt_data is None:
         return True, 0
 
     if attempt_data['count'] >= MAX_LOGIN_ATTEMPTS:
@@ -109,18 +222,16 @@ def check_rate_limit(identifier: str) -> tuple[bool, int]:
 
 def record_login_attempt(identifier: str, success: bool):
     current_time = time.time()
-    if success:
-        if identifier in LOGIN_ATTEMPTS:
-            del LOGIN_ATTEMPTS[identifier]
-    else:
-        if identifier not in LOGIN_ATTEMPTS:
-            LOGIN_ATTEMPTS[identifier] = {'count': 1, 'timestamp': current_time}
+    with LOGIN_ATTEMPTS_LOCK:
+        if success:
+            LOGIN_ATTEMPTS.pop(identifier, None)
         else:
-            LOGIN_ATTEMPTS[identifier]['count'] += 1
-            LOGIN_ATTEMPTS[identifier]['timestamp'] = current_time
+            # Reatribui a entrada para reiniciar o TTL a cada falha
+            count = LOGIN_ATTEMPTS.get(identifier, {'count': 0})['count'] + 1
+            LOGIN_ATTEMPTS[identifier] = {'count': count, 'timestamp': current_time}
 
-        # Debug: mostra o estado atual
-        print(f"[Rate Limit] {identifier}: {LOGIN_ATTEMPTS[identifier]['count']} tentativas")
+            # Debug: mostra o estado atual
+            print(f"[Rate Limit] {identifier}: {count} tentativas")
 
 
 def sanitize_input(value: str, max_length: int = 255) -> str:
@@ -131,200 +242,354 @@ def sanitize_input(value: str, max_length: int = 255) -> str:
 
 
 def validate_email(email: str) -> bool:
-    import re
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_RE.match(email) is not None
 
 
 # ============================================================================
 # FUNÇÕES DO BANCO DE DADOS (COM PROTEÇÃO SQL INJECTION)
 # ============================================================================
 
-def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+# Consultas frequentes preparadas uma vez por conexão (evita parse/plan a cada execução)
+PREPARED_STATEMENTS = {
+    'auth_stmt': "PREPARE auth_stmt(text) AS "
+                 "SELECT id, name, email, role, password_hash FROM users WHERE email = $1",
+    'in_progress_stmt': "PREPARE in_progress_stmt(integer) AS "
+                        "SELECT id, flow_run_id, status, created_at < NOW() - $1 * INTERVAL '1 second' AS expired "
+                        "FROM reports "
+                        "WHERE status IN ('pending', 'scheduled', 'running') AND flow_run_id IS NOT NULL",
+    'update_flow_status_stmt': "PREPARE update_flow_status_stmt(text, text) AS "
+                               "UPDATE reports SET status = $1, updated_at = NOW() "
+                               "WHERE flow_run_id = $2 AND status IN ('pending', 'scheduled', 'running') "
+                               "AND status IS DISTINCT FROM $1",
+}
 
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
+class PoolConnection(psycopg2.extensions.connection):
+    """Conexão do pool que registra quais statements já foram preparados nela"""
 
-    cur.execute('''CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(255) NOT NULL,
-        email VARCHAR(255) UNIQUE NOT NULL,
-        password_hash BYTEA NOT NULL,
-        role VARCHAR(50) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-
-    cur.execute('''CREATE TABLE IF NOT EXISTS company (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(255) UNIQUE NOT NULL,
-        address TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-
-    cur.execute('''CREATE TABLE IF NOT EXISTS reports (
-        id SERIAL PRIMARY KEY,
-        company_id INTEGER NOT NULL,
-        user_id INTEGER NOT NULL,
-        start_date DATE NOT NULL,
-        end_date DATE NOT NULL,
-        file_path VARCHAR(500),
-        status VARCHAR(50) NOT NULL,
-        flow_run_id VARCHAR(255),
-        generated_at TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-        FOREIGN KEY (company_id) REFERENCES company(id) ON DELETE CASCADE
-    )''')
-
-    cur.execute('''CREATE TABLE IF NOT EXISTS audit_logs (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER NOT NULL,
-        action VARCHAR(100) NOT NULL,
-        target_id INTEGER,
-        details JSONB,
-        ip_address VARCHAR(45),
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-    )''')
-
-    # Índices para performance
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_reports_user_id ON reports(user_id)''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_reports_company_id ON reports(company_id)''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status)''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at)''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_audit_logs_user_id ON audit_logs(user_id)''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_audit_logs_created_at ON audit_logs(created_at)''')
-
-    # Migração: Adiciona coluna flow_run_id se não existir
-    try:
-        cur.execute("""
-            SELECT column_name 
-            FROM information_schema.columns 
-            WHERE table_name=%s AND column_name=%s
-        """, ('reports', 'flow_run_id'))
-        if not cur.fetchone():
-            cur.execute("ALTER TABLE reports ADD COLUMN flow_run_id VARCHAR(255)")
-            conn.commit()
-    except Exception as e:
-        print(f"Aviso na migração: {e}")
-        conn.rollback()
-
-    # Criar usuário admin inicial apenas se não existir
-    cur.execute("SELECT * FROM users WHERE email = %s", ('admin@company.com',))
-    if not cur.fetchone():
-        admin_password = os.getenv('ADMIN_INITIAL_PASSWORD', 'Admin@123!Change')
-        password_hash = hash_password(admin_password)
-        cur.execute(
-            "INSERT INTO users (name, email, password_hash, role) VALUES (%s, %s, %s, %s)",
-            ('Admin User', 'admin@company.com', password_hash, 'admin')
-        )
-        print("⚠️  Usuário admin criado. Senha inicial:", admin_password)
-        print("⚠️  ALTERE A SENHA IMEDIATAMENTE!")
-
-    # Empresas de exemplo
-    companies = [
-        'SOHO LOUNGE',
-        'Supermercado Cezar',
-        'GUSTA +',
-        'Padaria Barcelona',
-        'PEIXE AMAZONICO',
-        'Vitoria Supermercado',
-        'Supermercado Meta',
-        'Nonno Cozinha Autoral',
-        'SUPERMERCADO COEMA',
-        'Juma Mercado Express',
-        'RESTAURANTE',
-        'Jota Burguer',
-        'Panificadora Leste Pan',
-        'O MAQUINISTA',
-        'Metazon/Moss',
-        'Padaria Nobre',
-        'REI DO CHURRASCO',
-        'SUPERMERCADO GOIANA',
-        'Brazin',
-        'Supermercado Xavier',
-        'Padaria Rio Tinto',
-        'Mindu Burger',
-        'Adolpho Shopping',
-        'Adolpho Restaurante',
-        'Colizeu Pizza',
-        'Palhoça',
-        'Adolpho Delivery',
-        'FPF',
-        'MESTRE PÃO P.10',
-        'Cali Sushi',
-        'RESTAURANTE CABOCLO',
-        'Gima Bar',
-        'SAN PAOLO',
-        'Ramalhete',
-        'FRANCOS PIZZA',
-        'Supermercado Peres 02',
-        'HOTEL RAMADA',
-        'Rodrigues Colchões',
-        'Panificadora Modelinho',
-        'Bento Sorvetes',
-        'Supermercado Peres 01',
-        'Kin',
-        'SEU LUIS',
-        'Estaleiro Rio Amazonas ERAM',
-        'SUPERMERCADO VIDAL',
-        'Ni Hachi',
-        'Hamburgella',
-        'COQUEIRO VERDE',
-        'PADARIA JASMYN',
-        'Sorveteira Kamby',
-        'SUPERMERCADO RODRIGUES',
-        'Hotel TRYP',
-        'Tortas & Tortas',
-        'CN SUPERMERCADOS',
-        'TREINAMENTO INTEGRAÇÃO',
-        'ATACK',
-        'Mestre do Pão',
-        'Adão e Eva',
-        'Kalena Café',
-        'Supermercado Rio Negro',
-        'SUPERMERCADO VENEZA',
-        'TAYCHI SUSHI',
-        'Torres Express',
-        'Requintes Pães e Tortas',
-        'PADARIA PÃO E VERSO',
-        'Cafe da Terra',
-        'Padaria Lisboa',
-        'Tokay Sushi'
-    ]
-
-    for company in companies:
-        cur.execute("""
-            INSERT INTO company (name, address)
-            VALUES (%s, NULL)
-            ON CONFLICT (name) DO NOTHING
-        """, (company,))
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
+@st.cache_resource
+def get_db_pool() -> ThreadedConnectionPool:
+    """Pool de conexões compartilhado por todas as sessões do processo"""
+    return ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, connection_factory=PoolConnection,
+                                  **DB_CONFIG)
 
-def log_audit(user_id: int, action: str, target_id: int = None, details: dict = None, ip_address: str = None):
+
+def execute_prepared(cur, name: str, params: tuple):
+    """Executa um statement de PREPARED_STATEMENTS, preparando-o na conexão no primeiro uso"""
+    conn = cur.connection
+    if name not in conn.prepared_statements:
+        cur.execute(PREPARED_STATEMENTS[name])
+        conn.prepared_statements.add(name)
+    cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params)
+
+
+def get_db_connection():
+    return get_db_pool().getconn()
+
+
+def release_db_connection(conn, close: bool = False):
+    get_db_pool().putconn(conn, close=close)
+
+
+@contextmanager
+def db_conn():
+    """Empresta uma conexão do pool e a devolve ao final, mesmo em caso de erro"""
+    conn = get_db_connection()
+    broken = False
     try:
-        conn = get_db_connection()
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # Conexão possivelmente derrubada pelo servidor: descarta em vez de devolver ao pool
+        broken = True
+        raise
+    finally:
+        release_db_connection(conn, close=broken or bool(conn.closed))
+
+
+def init_db():
+    with db_conn() as conn:
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO audit_logs (user_id, action, target_id, details, ip_address) VALUES (%s, %s, %s, %s, %s)",
-            (user_id, action, target_id, json.dumps(details) if details else None, ip_address)
-        )
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            password_hash BYTEA NOT NULL,
+            role VARCHAR(50) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS company (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) UNIQUE NOT NULL,
+            address TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS reports (
+            id SERIAL PRIMARY KEY,
+            company_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            start_date DATE NOT NULL,
+            end_date DATE NOT NULL,
+            file_path VARCHAR(500),
+            status VARCHAR(50) NOT NULL,
+            flow_run_id VARCHAR(255),
+            generated_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY (company_id) REFERENCES company(id) ON DELETE CASCADE
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS audit_logs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            action VARCHAR(100) NOT NULL,
+            target_id INTEGER,
+            details JSONB,
+            ip_address VARCHAR(45),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )''')
+
+        # Índices para performance (enviados em um único round-trip)
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_reports_user_id ON reports(user_id);
+            CREATE INDEX IF NOT EXISTS idx_reports_company_id ON reports(company_id);
+            CREATE INDEX IF NOT EXISTS idx_reports_company_created ON reports(company_id, created_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_reports_status ON reports(status);
+            CREATE INDEX IF NOT EXISTS idx_reports_active ON reports(status)
+                WHERE status IN ('pending', 'scheduled', 'running');
+            DROP INDEX IF EXISTS idx_reports_created_at;
+            CREATE INDEX IF NOT EXISTS idx_reports_created_id ON reports(created_at DESC, id DESC);
+            DROP INDEX IF EXISTS idx_audit_logs_user_id;
+            DROP INDEX IF EXISTS idx_audit_logs_created_at;
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_created_id ON audit_logs(created_at DESC, id DESC);
+            CREATE INDEX IF NOT EXISTS idx_audit_logs_user_created ON audit_logs(user_id, created_at DESC, id DESC);
+        ''')
+
+        # Agregações do dashboard pré-calculadas (atualizadas por refresh_dashboard_views)
+        cur.execute('''
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_reports_by_company AS
+                SELECT c.id AS company_id, c.name, COUNT(r.id) AS count
+                FROM reports r
+                JOIN company c ON r.company_id = c.id
+                GROUP BY c.id, c.name;
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_reports_by_company ON mv_reports_by_company(company_id);
+            CREATE MATERIALIZED VIEW IF NOT EXISTS mv_reports_over_time AS
+                SELECT DATE(created_at) AS date, COUNT(*) AS count
+                FROM reports
+                GROUP BY DATE(created_at);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_reports_over_time ON mv_reports_over_time(date);
+        ''')
+
+        # Notifica mudanças de status no canal report_status (LISTEN/NOTIFY)
+        cur.execute('''CREATE OR REPLACE FUNCTION notify_report_status() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('report_status', NEW.id || ':' || NEW.status);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql''')
+        cur.execute('''CREATE OR REPLACE TRIGGER reports_status_notify
+            AFTER UPDATE OF status ON reports
+            FOR EACH ROW
+            WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE FUNCTION notify_report_status()''')
+        # Inserções e exclusões não alteram status, mas mudam o dashboard: NOTIFY sem payload
+        cur.execute('''CREATE OR REPLACE FUNCTION notify_reports_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('report_status', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql''')
+        cur.execute('''CREATE OR REPLACE TRIGGER reports_changed_notify
+            AFTER INSERT OR DELETE ON reports
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION notify_reports_changed()''')
+
+        # Migração: Adiciona coluna flow_run_id se não existir
+        try:
+            cur.execute("""
+                SELECT 1
+                FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attname = %s AND NOT attisdropped
+            """, ('reports', 'flow_run_id'))
+            if not cur.fetchone():
+                cur.execute("ALTER TABLE reports ADD COLUMN flow_run_id VARCHAR(255)")
+                conn.commit()
+        except Exception as e:
+            print(f"Aviso na migração: {e}")
+            conn.rollback()
+
+        # Criar usuário admin inicial apenas se não existir
+        cur.execute("SELECT 1 FROM users WHERE email = %s", ('admin@company.com',))
+        if not cur.fetchone():
+            admin_password = os.getenv('ADMIN_INITIAL_PASSWORD', 'Admin@123!Change')
+            password_hash = hash_password(admin_password)
+            cur.execute(
+                "INSERT INTO users (name, email, password_hash, role) VALUES (%s, %s, %s, %s)",
+                ('Admin User', 'admin@company.com', password_hash, 'admin')
+            )
+            print("⚠️  Usuário admin criado. Senha inicial:", admin_password)
+            print("⚠️  ALTERE A SENHA IMEDIATAMENTE!")
+
+        # Empresas de exemplo
+        companies = [
+            'SOHO LOUNGE',
+            'Supermercado Cezar',
+            'GUSTA +',
+            'Padaria Barcelona',
+            'PEIXE AMAZONICO',
+            'Vitoria Supermercado',
+            'Supermercado Meta',
+            'Nonno Cozinha Autoral',
+            'SUPERMERCADO COEMA',
+            'Juma Mercado Express',
+            'RESTAURANTE',
+            'Jota Burguer',
+            'Panificadora Leste Pan',
+            'O MAQUINISTA',
+            'Metazon/Moss',
+            'Padaria Nobre',
+            'REI DO CHURRASCO',
+            'SUPERMERCADO GOIANA',
+            'Brazin',
+            'Supermercado Xavier',
+            'Padaria Rio Tinto',
+            'Mindu Burger',
+            'Adolpho Shopping',
+            'Adolpho Restaurante',
+            'Colizeu Pizza',
+            'Palhoça',
+            'Adolpho Delivery',
+            'FPF',
+            'MESTRE PÃO P.10',
+            'Cali Sushi',
+            'RESTAURANTE CABOCLO',
+            'Gima Bar',
+            'SAN PAOLO',
+            'Ramalhete',
+            'FRANCOS PIZZA',
+            'Supermercado Peres 02',
+            'HOTEL RAMADA',
+            'Rodrigues Colchões',
+            'Panificadora Modelinho',
+            'Bento Sorvetes',
+            'Supermercado Peres 01',
+            'Kin',
+            'SEU LUIS',
+            'Estaleiro Rio Amazonas ERAM',
+            'SUPERMERCADO VIDAL',
+            'Ni Hachi',
+            'Hamburgella',
+            'COQUEIRO VERDE',
+            'PADARIA JASMYN',
+            'Sorveteira Kamby',
+            'SUPERMERCADO RODRIGUES',
+            'Hotel TRYP',
+            'Tortas & Tortas',
+            'CN SUPERMERCADOS',
+            'TREINAMENTO INTEGRAÇÃO',
+            'ATACK',
+            'Mestre do Pão',
+            'Adão e Eva',
+            'Kalena Café',
+            'Supermercado Rio Negro',
+            'SUPERMERCADO VENEZA',
+            'TAYCHI SUSHI',
+            'Torres Express',
+            'Requintes Pães e Tortas',
+            'PADARIA PÃO E VERSO',
+            'Cafe da Terra',
+            'Padaria Lisboa',
+            'Tokay Sushi'
+        ]
+
+        # Insere apenas as que ainda não existem (ON CONFLICT cobre corridas entre processos)
+        cur.execute("SELECT name FROM company WHERE name = ANY(%s)", (companies,))
+        existing = {row[0] for row in cur.fetchall()}
+        missing = [(company, None) for company in companies if company not in existing]
+        if missing:
+            execute_values(cur, """
+                INSERT INTO company (name, address)
+                VALUES %s
+                ON CONFLICT (name) DO NOTHING
+            """, missing)
+
         conn.commit()
         cur.close()
-        conn.close()
+
+
+def write_audit_batch(batch: list):
+    """Grava um lote de registros de auditoria em um único INSERT"""
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO audit_logs (user_id, action, target_id, details, ip_address, created_at) VALUES %s",
+                batch,
+                page_size=AUDIT_BATCH_SIZE
+            )
+            conn.commit()
+            cur.close()
     except Exception as e:
         print(f"Erro ao registrar auditoria: {e}")
 
 
+def audit_writer(audit_queue: queue.Queue):
+    """Consome a fila de auditoria, agrupando até AUDIT_BATCH_SIZE registros
+    ou AUDIT_FLUSH_INTERVAL segundos por escrita; None na fila encerra o writer"""
+    stopping = False
+    while not stopping:
+        item = audit_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+        try:
+            while len(batch) < AUDIT_BATCH_SIZE:
+                item = audit_queue.get(timeout=max(0, deadline - time.monotonic()))
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+        except queue.Empty:
+            pass
+        write_audit_batch(batch)
+
+
+def stop_audit_writer(audit_queue: queue.Queue, writer: Thread):
+    """Encerramento do processo: o writer grava o que restou na fila e termina"""
+    audit_queue.put(None)
+    writer.join(timeout=AUDIT_SHUTDOWN_TIMEOUT)
+    if writer.is_alive():
+        print(f"Auditoria: writer não terminou em {AUDIT_SHUTDOWN_TIMEOUT}s; registros pendentes perdidos")
+
+
+@st.cache_resource
+def get_audit_queue() -> queue.Queue:
+    """Fila de auditoria do processo, gravada em segundo plano fora do caminho da requisição"""
+    audit_queue = queue.Queue()
+    writer = Thread(target=audit_writer, args=(audit_queue,), daemon=True, name='audit-writer')
+    writer.start()
+    atexit.register(stop_audit_writer, audit_queue, writer)
+    return audit_queue
+
+
+def log_audit(user_id: int, action: str, target_id: int = None, details: dict = None, ip_address: str = None):
+    # created_at é fixado aqui: a gravação em lote acontece alguns segundos depois
+    get_audit_queue().put((user_id, action, target_id, json.dumps(details) if details else None, ip_address,
+                           datetime.now()))
+
+
 def authenticate(email: str, password: str) -> tuple:
     if not validate_email(email):
         return None
@@ -335,22 +600,17 @@ def authenticate(email: str, password: str) -> tuple:
         raise Exception(f"Muitas tentativas de login. Tente novamente em {time_remaining} segundos")
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, name, email, password_hash, role FROM users WHERE email = %s",
-            (email,)
-        )
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
-        if user and verify_password(password, user[3]):
+        with db_conn() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, 'auth_stmt', (email,))
+            user = cur.fetchone()
+            cur.close()
+        if user and verify_password(password, user[4]):
             record_login_attempt(email, True)
             # Retorna tupla sem o hash da senha
-            return (user[0], user[1], user[2], user[4])
+            return user[:4]
         else:
             record_login_attempt(email, False)
-            print(LOGIN_ATTEMPTS)
             return None
 
     except Exception as e:
@@ -358,18 +618,60 @@ def authenticate(email: str, password: str) -> tuple:
         return None
 
 
+def read_sql(conn, query: str, params=None, itersize: int = None) -> pd.DataFrame:
+    """Executa a consulta e monta o DataFrame direto a partir do cursor.
+
+    Com itersize, usa um cursor nomeado (server-side) que traz as linhas em lotes,
+    evitando materializar o resultado inteiro no cliente de uma só vez.
+    """
+    cur = conn.cursor(name='read_sql') if itersize else conn.cursor()
+    try:
+        if itersize:
+            cur.itersize = itersize
+        cur.execute(query, params)
+        rows = list(cur)
+        columns = [column[0] for column in cur.description]
+    finally:
+        cur.close()
+    return pd.DataFrame(rows, columns=columns)
+
+
+@st.cache_data(ttl=LOOKUP_CACHE_TTL)
+def load_companies() -> list:
+    """Lista de empresas [(id, name)] usada nos filtros e seletores"""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name FROM company ORDER BY name")
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
+@st.cache_data(ttl=LOOKUP_CACHE_TTL)
+def load_users() -> list:
+    """Lista de usuários [(id, name)] usada nos filtros"""
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name FROM users ORDER BY name")
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+
 # ============================================================================
 # FUNÇÕES S3/MinIO
 # ============================================================================
 
+@st.cache_resource
 def get_s3_client():
-    """Cria cliente S3 seguro"""
+    """Cliente S3 seguro, criado uma única vez e compartilhado pelo processo"""
     return boto3.client(
         's3',
         region_name=S3_REGION,
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        endpoint_url=MINIO_ENDPOINT
+        endpoint_url=MINIO_ENDPOINT,
+        config=Config(max_pool_connections=20, retries={'max_attempts': 3, 'mode': 'standard'})
     )
 
 
@@ -381,8 +683,45 @@ def download_report_from_s3(file_path: str) -> bytes:
 
     try:
         s3_client = get_s3_client()
-        response = s3_client.get_object(Bucket=S3_BUCKET, Key=full_path)
-        return response['Body'].read()
+        # Grava os chunks no buffer à medida que chegam, sem montar o corpo inteiro antes
+        buffer = io.BytesIO()
+        s3_client.download_fileobj(S3_BUCKET, full_path, buffer)
+        return buffer.getvalue()
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code in ('NoSuchKey', '404'):
+            print(f"Arquivo não encontrado no S3: {file_path}")
+        else:
+            print(f"Erro ao baixar arquivo do S3: {e}")
+        return None
+    except Exception as e:
+        print(f"Erro inesperado: {e}")
+        return None
+
+
+def download_report_preview_from_s3(file_path: str) -> bytes:
+    """Download parcial (início e fim do arquivo) suficiente para o preview.
+
+    O intervalo não baixado é preenchido com zeros para o fim do arquivo
+    ficar no offset original e a tabela xref continuar válida.
+    """
+    file_path = file_path.replace('..', '').replace('//', '/')
+    full_path = f"lm/reports/{file_path}"
+
+    try:
+        s3_client = get_s3_client()
+        response = s3_client.get_object(
+            Bucket=S3_BUCKET, Key=full_path, Range=f"bytes=0-{PREVIEW_HEAD_BYTES - 1}"
+        )
+        total_size = int(response['ContentRange'].split('/')[-1])
+        content = response['Body'].read()
+
+        if total_size > len(content):
+            tail_start = max(len(content), total_size - PREVIEW_TAIL_BYTES)
+            response = s3_client.get_object(Bucket=S3_BUCKET, Key=full_path, Range=f"bytes={tail_start}-")
+            content += bytes(tail_start - len(content)) + response['Body'].read()
+
+        return content
     except ClientError as e:
         error_code = e.response['Error']['Code']
         if error_code == 'NoSuchKey':
@@ -395,69 +734,137 @@ def download_report_from_s3(file_path: str) -> bytes:
         return None
 
 
-def check_file_exists_in_s3(file_path: str) -> bool:
-    """Verifica se arquivo existe no S3"""
+def download_report_parallel(file_path: str, chunk: int = PARALLEL_DOWNLOAD_CHUNK,
+                             workers: int = PARALLEL_DOWNLOAD_WORKERS) -> bytes:
+    """Download em partes paralelas para arquivos grandes; GET único para os demais"""
     file_path = file_path.replace('..', '').replace('//', '/')
     full_path = f"lm/reports/{file_path}"
 
     try:
         s3_client = get_s3_client()
-        s3_client.head_object(Bucket=S3_BUCKET, Key=full_path)
-        return True
+        size = s3_client.head_object(Bucket=S3_BUCKET, Key=full_path)['ContentLength']
+        if size <= PARALLEL_DOWNLOAD_THRESHOLD:
+            return download_report_from_s3(file_path)
+
+        def fetch_range(byte_range):
+            start, end = byte_range
+            response = s3_client.get_object(Bucket=S3_BUCKET, Key=full_path, Range=f"bytes={start}-{end}")
+            return response['Body'].read()
+
+        ranges = [(start, min(start + chunk, size) - 1) for start in range(0, size, chunk)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return b''.join(executor.map(fetch_range, ranges))
     except ClientError as e:
-        return e.response['Error']['Code'] != '404'
-    except Exception:
-        return False
+        error_code = e.response['Error']['Code']
+        if error_code in ('NoSuchKey', '404'):
+            print(f"Arquivo não encontrado no S3: {file_path}")
+        else:
+            print(f"Erro ao baixar arquivo do S3: {e}")
+        return None
+    except Exception as e:
+        print(f"Erro inesperado: {e}")
+        return None
+
 
+@st.cache_data(ttl=S3_HEAD_CACHE_TTL, show_spinner=False)
+def get_report_etag(file_path: str) -> str:
+    """ETag do relatório no S3.
+
+    Levanta FileNotFoundError se o arquivo não existir e ValueError em outras falhas; nenhum dos casos fica em cache.
+    """
+    file_path = file_path.replace('..', '').replace('//', '/')
+    full_path = f"lm/reports/{file_path}"
 
-def generate_pdf_preview(pdf_content: bytes, max_pages: int = 3) -> tuple:
-    """Gera preview seguro das primeiras páginas do PDF"""
     try:
-        pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
-        preview_images = []
-        total_pages = len(pdf_document)
-
-        for page_num in range(min(max_pages, total_pages)):
-            page = pdf_document[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-            img_data = pix.tobytes("png")
-            preview_images.append(img_data)
-            pix = None
-
-        pdf_document.close()
-        return preview_images, total_pages
+        s3_client = get_s3_client()
+        return s3_client.head_object(Bucket=S3_BUCKET, Key=full_path)['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise FileNotFoundError(full_path) from e
+        print(f"Erro ao consultar arquivo no S3: {e}")
+        raise ValueError("Erro ao consultar arquivo") from e
+    except Exception as e:
+        print(f"Erro inesperado: {e}")
+        raise ValueError("Erro ao consultar arquivo") from e
+
+
+def generate_pdf_preview(pdf_content: bytes, page_num: int, allow_repair: bool = True) -> tuple:
+    """Gera preview seguro de uma página do PDF (array RGB, sem codificar PNG); retorna (imagem, total de páginas)"""
+    from pdf_preview import render_page  # PyMuPDF, carregado só quando há preview
+
+    try:
+        return render_page(pdf_content, page_num, allow_repair=allow_repair)
     except Exception as e:
         print(f"Erro ao gerar preview: {e}")
         return None, 0
 
 
+@st.cache_resource(max_entries=REPORT_BYTES_CACHE_ENTRIES, ttl=3600, show_spinner=False)
+def load_report_bytes(file_path: str, etag: str) -> bytes:
+    """Conteúdo completo do relatório em cache por (arquivo, ETag), sem cópia a cada acesso"""
+    content = download_report_parallel(file_path)
+    if not content:
+        raise ValueError("Erro ao baixar arquivo")
+    return content
+
+
+@st.cache_data(max_entries=64, ttl=3600, show_spinner=False)
+def load_pdf_preview(file_path: str, etag: str, page_num: int = 0) -> tuple:
+    """Uma página do preview em cache por (arquivo, ETag, página); retorna (imagem, total de páginas).
+
+    Falhas levantam ValueError e não ficam em cache.
+    """
+    content = download_report_preview_from_s3(file_path)
+    image, total = generate_pdf_preview(content, page_num, allow_repair=False) if content else (None, 0)
+    if image is None:
+        # Página fora do trecho parcial ou documento reparado pelo MuPDF: recorre ao arquivo completo (que fica em cache para o download)
+        content = load_report_bytes(file_path, etag)
+        image, total = generate_pdf_preview(content, page_num)
+        if image is None:
+            raise ValueError("Erro ao gerar preview")
+    return image, total
+
+
 # ============================================================================
 # FUNÇÕES PREFECT
 # ============================================================================
 
+@st.cache_resource
+def get_prefect_session() -> requests.Session:
+    """Sessão HTTP com pool de conexões reutilizado nas chamadas ao Prefect"""
+    session = requests.Session()
+    session.auth = (PREFECT_USERNAME, PREFECT_PASSWORD)
+    session.headers['Content-Type'] = 'application/json'
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=32,
+        # POST só é repetido porque cada acionamento leva um idempotency_key (ver trigger_prefect_flow)
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                          allowed_methods=frozenset({'POST'}))
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def trigger_prefect_flow(parameters: dict) -> dict:
     """Aciona flow do Prefect de forma segura"""
     try:
-        headers = {'Content-Type': 'application/json'}
         url = f"{PREFECT_API_URL}/flow_runs/"
 
         payload = {
             'parameters': parameters,
-            'flow_id': os.getenv('PREFECT_FLOW_ID'),
-            'deployment_id': os.getenv('PREFECT_DEPLOYMENT_ID'),
-            'work_pool_name': os.getenv('PREFECT_WORK_POOL', 'lm'),
-            'state': {'type': 'SCHEDULED'}
+            'flow_id': PREFECT_FLOW_ID,
+            'deployment_id': PREFECT_DEPLOYMENT_ID,
+            'work_pool_name': PREFECT_WORK_POOL,
+            'state': {'type': 'SCHEDULED'},
+            # Uma nova tentativa com a mesma chave devolve o flow run já criado em vez de duplicá-lo
+            'idempotency_key': str(uuid.uuid4())
         }
 
-        response = requests.post(
-            url,
-            json=payload,
-            headers=headers,
-            auth=(PREFECT_USERNAME, PREFECT_PASSWORD),
-            timeout=10
-        )
+        response = get_prefect_session().post(url, data=orjson.dumps(payload), timeout=10)
         response.raise_for_status()
-        result = response.json()
+        result = orjson.loads(response.content)
 
         return {
             'success': True,
@@ -465,7 +872,7 @@ def trigger_prefect_flow(parameters: dict) -> dict:
             'status': result.get('state', {}).get('type'),
             'message': 'Flow acionado com sucesso'
         }
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
         return {
             'success': False,
             'error': str(e),
@@ -473,145 +880,395 @@ def trigger_prefect_flow(parameters: dict) -> dict:
         }
 
 
-def check_flow_run_status(flow_run_id: str) -> dict:
-    """Verifica status do flow de forma segura"""
-    try:
-        headers = {'Content-Type': 'application/json'}
-        url = f"{PREFECT_API_URL}/flow_runs/{flow_run_id}"
-
-        response = requests.get(
-            url,
-            headers=headers,
-            auth=(PREFECT_USERNAME, PREFECT_PASSWORD),
-            timeout=10
-        )
-        response.raise_for_status()
-        result = response.json()
+@st.cache_resource
+def get_polling_loop() -> asyncio.AbstractEventLoop:
+    """Event loop compartilhado, em thread própria, para o polling dos flows"""
+    loop = asyncio.new_event_loop()
+    # Acesso bloqueante ao banco (asyncio.to_thread) em um pool pequeno e reaproveitado
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=POLLING_DB_WORKERS,
+                                                 thread_name_prefix='prefect-polling-db'))
+    Thread(target=loop.run_forever, daemon=True, name='prefect-polling').start()
+    return loop
+
+
+@st.cache_resource
+def get_prefect_async_client() -> httpx.AsyncClient:
+    """Cliente HTTP assíncrono (keep-alive) usado pelo polling do Prefect"""
+    return httpx.AsyncClient(
+        base_url=PREFECT_API_URL,
+        auth=(PREFECT_USERNAME, PREFECT_PASSWORD),
+        headers={'Content-Type': 'application/json'},
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32)
+    )
 
-        return {
-            'success': True,
-            'status': result.get('state', {}).get('type'),
-            'name': result.get('name'),
-            'start_time': result.get('start_time'),
-            'end_time': result.get('end_time')
-        }
-    except requests.exceptions.RequestException as e:
-        return {'success': False, 'error': str(e)}
 
+@st.cache_resource
+def get_prefect_semaphore() -> asyncio.Semaphore:
+    """Limita as requisições ao Prefect em andamento ao mesmo tempo"""
+    return asyncio.Semaphore(PREFECT_MAX_CONCURRENT_REQUESTS)
 
-def update_report_status(report_id: int, status: str, file_path: str = None) -> bool:
-    """Atualiza status do relatório de forma segura"""
-    try:
-        conn = get_db_connection()
+
+def get_in_progress_reports() -> list:
+    """Lista relatórios em andamento com flow associado"""
+    with db_conn() as conn:
         cur = conn.cursor()
+        execute_prepared(cur, 'in_progress_stmt', (POLLING_TIMEOUT,))
+        rows = cur.fetchall()
+        cur.close()
+    return rows
 
-        if file_path:
-            cur.execute("""
-                UPDATE reports 
-                SET status = %s, file_path = %s, updated_at = %s
-                WHERE id = %s
-            """, (status, file_path, datetime.now(), report_id))
-        else:
-            cur.execute("""
-                UPDATE reports 
-                SET status = %s, updated_at = %s
-                WHERE id = %s
-            """, (status, datetime.now(), report_id))
 
-        conn.commit()
-        cur.close()
-        conn.close()
+def update_reports_status_bulk(updates: list) -> bool:
+    """Atualiza o status de vários relatórios em um único UPDATE"""
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            execute_values(cur, """
+                UPDATE reports AS r
+                SET status = v.status, updated_at = NOW()
+                FROM (VALUES %s) AS v(id, status)
+                WHERE r.id = v.id AND r.status IS DISTINCT FROM v.status
+            """, updates, page_size=len(updates))
+            conn.commit()
+            cur.close()
         return True
     except Exception as e:
         print(f"Erro ao atualizar status: {e}")
         return False
 
 
-def poll_flow_status(report_id: int, flow_run_id: str, max_attempts: int = 600, interval: int = 5):
-    """Polling do status do flow"""
-    attempts = 0
-    final_states = ['COMPLETED', 'FAILED', 'CANCELLED', 'CRASHED']
+async def fetch_flow_run_states(client: httpx.AsyncClient, flow_run_ids: list) -> dict:
+    """Consulta o estado de vários flow runs via /flow_runs/filter"""
+    async def fetch_batch(batch: list) -> list:
+        async with get_prefect_semaphore():
+            response = await client.post("/flow_runs/filter", content=orjson.dumps({
+                'flow_runs': {'id': {'any_': batch}},
+                'limit': len(batch)
+            }))
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    batches = [flow_run_ids[start:start + PREFECT_FILTER_LIMIT]
+               for start in range(0, len(flow_run_ids), PREFECT_FILTER_LIMIT)]
+    states = {}
+    for flow_runs in await asyncio.gather(*(fetch_batch(batch) for batch in batches)):
+        for flow_run in flow_runs:
+            states[flow_run['id']] = (flow_run.get('state') or {}).get('type')
+    return states
 
-    while attempts < max_attempts:
+
+def polling_delay(idle_polls: int, cap: int = POLLING_MAX_INTERVAL) -> float:
+    """Backoff exponencial com jitter a partir do número de polls sem mudança"""
+    delay = min(cap, POLLING_MIN_INTERVAL * 2 ** min(idle_polls, 6))
+    return delay + random.uniform(0, POLLING_JITTER)
+
+
+def update_flow_run_status(flow_run_id: str, status: str) -> bool:
+    """Atualiza o relatório em andamento associado a um flow run"""
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, 'update_flow_status_stmt', (status, flow_run_id))
+            conn.commit()
+            cur.close()
+        return True
+    except Exception as e:
+        print(f"Erro ao atualizar status: {e}")
+        return False
+
+
+async def listen_flow_run_events(connected: asyncio.Event):
+    """Recebe as mudanças de estado dos flow runs pelo stream de eventos do Prefect"""
+    auth_string = f"{PREFECT_USERNAME}:{PREFECT_PASSWORD}"
+    credentials = base64.b64encode(auth_string.encode()).decode()
+    while True:
         try:
-            status_result = check_flow_run_status(flow_run_id)
-            if status_result['success']:
-                current_status = status_result['status']
-                status_mapping = {
-                    'SCHEDULED': 'scheduled', 'PENDING': 'pending',
-                    'RUNNING': 'running', 'COMPLETED': 'completed',
-                    'FAILED': 'failed', 'CANCELLED': 'cancelled',
-                    'CRASHED': 'failed'
-                }
-                db_status = status_mapping.get(current_status, 'pending')
-                update_report_status(report_id, db_status)
+            async with ws_connect(PREFECT_EVENTS_URL, subprotocols=['prefect'],
+                                  additional_headers={'Authorization': f'Basic {credentials}'}) as ws:
+                await ws.send(orjson.dumps({'type': 'auth', 'token': auth_string}).decode())
+                if orjson.loads(await ws.recv()).get('type') != 'auth_success':
+                    raise ConnectionError("autenticação recusada pelo stream de eventos")
+                await ws.send(orjson.dumps({
+                    'type': 'filter',
+                    'filter': {'event': {'prefix': ['prefect.flow-run.']}}
+                }).decode())
+                connected.set()
+
+                async for message in ws:
+                    payload = orjson.loads(message)
+                    if payload.get('type') != 'event':
+                        continue
+                    resource = payload['event'].get('resource', {})
+                    status = PREFECT_STATUS_MAP.get(resource.get('prefect.state-type'))
+                    if status is None:
+                        continue
+                    flow_run_id = resource.get('prefect.resource.id', '').removeprefix('prefect.flow-run.')
+                    await asyncio.to_thread(update_flow_run_status, flow_run_id, status)
+        except Exception as e:
+            print(f"[Eventos] Erro: {e}")
+        connected.clear()
+        await asyncio.sleep(POLLING_INTERVAL)
 
-                if current_status in final_states:
-                    break
 
-            time.sleep(interval)
-            attempts += 1
+async def poll_flow_statuses(client: httpx.AsyncClient, events_connected: asyncio.Event,
+                             wakeup: asyncio.Event):
+    """Polling único do status de todos os flows em andamento
+
+    Enquanto o stream de eventos está conectado o polling só cobre eventos
+    perdidos e timeouts, com teto de POLLING_FALLBACK_INTERVAL.
+    """
+    last_report_ids = None
+    idle_polls = 0
+
+    while True:
+        try:
+            updates = []
+            reports = await asyncio.to_thread(get_in_progress_reports)
+            if reports:
+                states = await fetch_flow_run_states(client, [flow_run_id for _, flow_run_id, _, _ in reports])
+
+                for report_id, flow_run_id, db_status, expired in reports:
+                    current_status = states.get(flow_run_id)
+                    if current_status is None and not expired:
+                        continue
+                    if expired and current_status not in PREFECT_FINAL_STATES:
+                        new_status = 'timeout'
+                    else:
+                        new_status = PREFECT_STATUS_MAP.get(current_status, 'pending')
+                    # Só grava quando o status realmente mudou
+                    if new_status != db_status:
+                        updates.append((report_id, new_status))
+
+                if updates:
+                    await asyncio.to_thread(update_reports_status_bulk, updates)
+
+            # Novos relatórios ou mudança de estado voltam ao intervalo mínimo
+            report_ids = [report_id for report_id, _, _, _ in reports]
+            if updates or report_ids != last_report_ids:
+                idle_polls = 0
+            else:
+                idle_polls += 1
+            last_report_ids = report_ids
         except Exception as e:
             print(f"[Polling] Erro: {e}")
-            time.sleep(interval)
-            attempts += 1
+            idle_polls += 1
 
-    if attempts >= max_attempts:
-        update_report_status(report_id, 'timeout')
+        cap = POLLING_FALLBACK_INTERVAL if events_connected.is_set() else POLLING_MAX_INTERVAL
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=polling_delay(idle_polls, cap))
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
 
 
-def start_polling_thread(report_id: int, flow_run_id: str):
-    """Inicia thread de polling"""
-    thread = Thread(target=poll_flow_status, args=(report_id, flow_run_id), daemon=True)
-    thread.start()
-    return thread
+@st.cache_resource
+def get_poller_wakeup() -> asyncio.Event:
+    """Evento que interrompe a espera do polling (ex.: novo relatório acionado)"""
+    return asyncio.Event()
 
 
-def get_dashboard_stats(conn):
-    """Obtém estatísticas do dashboard de forma segura"""
-    stats = {}
+def wake_status_poller():
+    """Faz o polling rodar já, sem esperar o backoff atual"""
+    get_polling_loop().call_soon_threadsafe(get_poller_wakeup().set)
+
+
+@st.cache_resource
+def start_status_poller():
+    """Agenda, uma única vez por processo, o polling no event loop compartilhado"""
+    loop = get_polling_loop()
+    client = get_prefect_async_client()
+    events_connected = asyncio.Event()
+    return (
+        asyncio.run_coroutine_threadsafe(listen_flow_run_events(events_connected), loop),
+        asyncio.run_coroutine_threadsafe(poll_flow_statuses(client, events_connected, get_poller_wakeup()), loop),
+    )
+
+
+def refresh_dashboard_views() -> bool:
+    """Recalcula as materialized views do dashboard sem bloquear leituras
+
+    Retorna False sem fazer nada se outro processo já está atualizando as views.
+    """
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (DASHBOARD_VIEWS_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            cur.close()
+            return False
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_reports_by_company")
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_reports_over_time")
+        conn.commit()
+        cur.close()
+    return True
+
+
+async def refresh_dashboard_views_periodically(dashboard_version: dict, interval: int = DASHBOARD_VIEWS_REFRESH):
+    """Atualiza as agregações do dashboard só quando algum relatório mudou desde o último refresh
+
+    Se outro processo detém o lock, a mudança fica por conta dele.
+    """
+    refreshed_version = None
+    while True:
+        version = dashboard_version['value']
+        if version != refreshed_version:
+            try:
+                await asyncio.to_thread(refresh_dashboard_views)
+                refreshed_version = version
+            except Exception as e:
+                print(f"[Dashboard] Erro ao atualizar views: {e}")
+        await asyncio.sleep(interval)
+
+
+@st.cache_resource
+def start_dashboard_refresher():
+    """Agenda, uma única vez por processo, o refresh das views no event loop compartilhado"""
+    return asyncio.run_coroutine_threadsafe(refresh_dashboard_views_periodically(get_dashboard_version()),
+                                            get_polling_loop())
+
+
+def listen_report_status(channels: dict, dashboard_version: dict, generation: dict):
+    """Escuta o canal report_status e entrega cada notificação à fila do relatório
+
+    Cada notificação também avança dashboard_version, invalidando o cache das
+    estatísticas do dashboard. generation avança a cada (re)conexão do LISTEN,
+    sinalizando que notificações podem ter se perdido no intervalo.
+    """
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute("LISTEN report_status")
+            generation['value'] += 1
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    dashboard_version['value'] += 1
+                    if not notify.payload:
+                        continue
+                    report_id, status = notify.payload.split(':', 1)
+                    channel = channels.get(int(report_id))
+                    if channel is not None:
+                        channel.put(status)
+        except Exception as e:
+            print(f"[Listener] Erro: {e}")
+            time.sleep(POLLING_INTERVAL)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+@st.cache_resource
+def get_report_status_channels() -> dict:
+    """Inicia, uma única vez por processo, a thread do LISTEN e devolve o registro de filas"""
+    channels = {}
+    Thread(target=listen_report_status, args=(channels, get_dashboard_version(), get_listener_generation()),
+           daemon=True, name='report-status-listener').start()
+    return channels
+
+
+def register_report_listener(report_id: int) -> queue.Queue:
+    """Registra interesse nas mudanças de status de um relatório"""
+    return get_report_status_channels().setdefault(report_id, queue.Queue())
+
+
+def unregister_report_listener(report_id: int):
+    get_report_status_channels().pop(report_id, None)
+
 
-    stats['total_reports'] = pd.read_sql_query(
-        "SELECT COUNT(*) as count FROM reports", conn
-    )['count'][0]
+def clear_watched_report():
+    """Deixa de acompanhar o relatório da sessão, liberando a fila dele"""
+    watched = st.session_state.get('watched_report')
+    if watched:
+        unregister_report_listener(watched['id'])
+    st.session_state.watched_report = None
 
-    stats['total_companies'] = pd.read_sql_query(
-        "SELECT COUNT(*) as count FROM company", conn
-    )['count'][0]
 
-    stats['total_users'] = pd.read_sql_query(
-        "SELECT COUNT(*) as count FROM users", conn
-    )['count'][0]
+def get_dashboard_stats(conn):
+    """Obtém estatísticas do dashboard de forma segura"""
+    stats = {}
+    cur = conn.cursor()
 
-    stats['pending_reports'] = pd.read_sql_query(
-        "SELECT COUNT(*) as count FROM reports WHERE status IN ('pending', 'scheduled', 'running')",
-        conn
-    )['count'][0]
+    cur.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM reports) AS total_reports,
+            (SELECT COUNT(*) FROM company) AS total_companies,
+            (SELECT COUNT(*) FROM users) AS total_users,
+            (SELECT COUNT(*) FROM reports WHERE status IN ('pending', 'scheduled', 'running')) AS pending_reports
+    """)
+    (stats['total_reports'], stats['total_companies'],
+     stats['total_users'], stats['pending_reports']) = cur.fetchone()
+    cur.close()
 
-    stats['reports_by_status'] = pd.read_sql_query(
-        "SELECT status, COUNT(*) as count FROM reports GROUP BY status", conn
+    stats['reports_by_status'] = read_sql(
+        conn, "SELECT status, COUNT(*) as count FROM reports GROUP BY status"
     )
 
-    stats['reports_by_company'] = pd.read_sql_query("""
-        SELECT c.name, COUNT(r.id) as count
-        FROM reports r
-        JOIN company c ON r.company_id = c.id
-        GROUP BY c.name
+    stats['reports_by_company'] = read_sql(conn, """
+        SELECT name, count
+        FROM mv_reports_by_company
         ORDER BY count DESC
         LIMIT 10
-    """, conn)
+    """)
 
-    stats['reports_over_time'] = pd.read_sql_query("""
-        SELECT DATE(created_at) as date, COUNT(*) as count
-        FROM reports
-        WHERE created_at >= CURRENT_DATE - INTERVAL '30 days'
-        GROUP BY DATE(created_at)
+    stats['reports_over_time'] = read_sql(conn, """
+        SELECT date, count
+        FROM mv_reports_over_time
+        WHERE date >= CURRENT_DATE - INTERVAL '30 days'
         ORDER BY date
-    """, conn)
+    """)
+    # datetime.date chega como object; converte uma vez para datetime64
+    stats['reports_over_time']['date'] = pd.to_datetime(stats['reports_over_time']['date'])
 
     return stats
 
 
+@st.cache_resource
+def get_dashboard_version() -> dict:
+    """Contador de mudanças de status, usado como chave do cache do dashboard"""
+    return {'value': 0}
+
+
+@st.cache_resource
+def get_listener_generation() -> dict:
+    """Contador de (re)conexões da thread do LISTEN"""
+    return {'value': 0}
+
+
+@st.cache_resource
+def get_last_dashboard_stats() -> dict:
+    """Últimas estatísticas carregadas, usadas se o banco estiver indisponível"""
+    return {}
+
+
+@st.cache_data(ttl=DASHBOARD_STATS_TTL, show_spinner=False)
+def load_dashboard_stats(version: int) -> dict:
+    """Estatísticas do dashboard compartilhadas entre sessões até a próxima mudança de status"""
+    with db_conn() as conn:
+        stats = get_dashboard_stats(conn)
+    get_last_dashboard_stats()['stats'] = stats
+    return stats
+
+
+def fetch_dashboard_stats() -> tuple:
+    """Estatísticas atuais do dashboard ou, se o banco falhar, as últimas carregadas"""
+    try:
+        return load_dashboard_stats(get_dashboard_version()['value']), False
+    except Exception as e:
+        stats = get_last_dashboard_stats().get('stats')
+        if stats is None:
+            raise
+        print(f"Erro ao atualizar dashboard, exibindo últimos dados: {e}")
+        return stats, True
+
+
 # ============================================================================
 # INTERFACE STREAMLIT
 # ============================================================================
@@ -620,22 +1277,55 @@ if 'logged_in' not in st.session_state:
     st.session_state.logged_in = False
 if 'user' not in st.session_state:
     st.session_state.user = None
-if 'current_page' not in st.session_state:
-    st.session_state.current_page = 1
+if 'selected_report' not in st.session_state:
+    st.session_state.selected_report = None
+if 'watched_report' not in st.session_state:
+    st.session_state.watched_report = None
+if 'audit_logs_cursor' not in st.session_state:
+    st.session_state.audit_logs_cursor = None
+if 'reports_cursors' not in st.session_state:
+    st.session_state.reports_cursors = [None]
+if 'preview_file' not in st.session_state:
+    st.session_state.preview_file = None
 
 try:
+    st.set_page_config(
+        page_title="Portal de Relatórios",
+        page_icon="📊",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+except StreamlitAPIException:
+    pass
+
+
+@st.cache_resource
+def bootstrap():
+    """Inicializa o banco uma única vez por processo (e não a cada rerun)"""
     init_db()
+    return True
+
+
+try:
+    bootstrap()
 except Exception as e:
     print(e)
     st.error("Erro ao inicializar banco de dados")
     st.stop()
 
-st.set_page_config(
-    page_title="Portal de Relatórios",
-    page_icon="📊",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+start_status_poller()
+start_dashboard_refresher()
+get_report_status_channels()
+
+
+def page_selector(total_items: int, key: str) -> tuple:
+    """Seletor de página para listagens paginadas no banco; retorna (página, total de páginas)"""
+    total_pages = max(1, (total_items + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+    if st.session_state.get(key, 1) > total_pages:
+        st.session_state[key] = total_pages
+
+    current_page = st.number_input(f"Página (1-{total_pages})", min_value=1, max_value=total_pages, key=key)
+    return current_page, total_pages
 
 
 def login_page():
@@ -665,8 +1355,7 @@ def login_page():
                         'role': user[3]
                     }
                     log_audit(user[0], 'login')
-                    st.success("Login realizado com sucesso!")
-                    time.sleep(1)
+                    st.toast("Login realizado com sucesso!", icon="✅")
                     st.rerun()
                 else:
                     st.error("❌ Credenciais inválidas")
@@ -683,6 +1372,7 @@ def main_app():
 
     if st.sidebar.button("🚪 Sair"):
         log_audit(st.session_state.user['id'], 'logout')
+        clear_watched_report()
         st.session_state.logged_in = False
         st.session_state.user = None
         st.rerun()
@@ -694,6 +1384,9 @@ def main_app():
         ["📊 Dashboard", "📄 Relatórios", "🏢 Empresas", "👥 Usuários", "📋 Logs de Auditoria"]
     )
 
+    if menu != "📄 Relatórios" and st.session_state.watched_report:
+        clear_watched_report()
+
     if menu == "📊 Dashboard":
         dashboard_page()
     elif menu == "📄 Relatórios":
@@ -706,23 +1399,43 @@ def main_app():
         audit_logs_page()
 
 
+@st.fragment(run_every=5)
+def dashboard_metrics_fragment():
+    """Contadores do dashboard, atualizados ao vivo quando um status muda"""
+    try:
+        stats, _ = fetch_dashboard_stats()
+    except Exception as e:
+        print(f"Erro: {e}")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Total de Relatórios", stats['total_reports'])
+    with col2:
+        st.metric("Total de Empresas", stats['total_companies'])
+    with col3:
+        st.metric("Total de Usuários", stats['total_users'])
+    with col4:
+        st.metric("Em Andamento", stats['pending_reports'])
+
+
 def dashboard_page():
     """Dashboard com gráficos"""
+    # plotly só é carregado quando o dashboard é aberto
+    import plotly.express as px
+    import plotly.graph_objects as go
+
     st.title("📊 Dashboard")
 
+    if st.button("🔄 Atualizar"):
+        load_dashboard_stats.clear()
+
     try:
-        conn = get_db_connection()
-        stats = get_dashboard_stats(conn)
+        stats, stale = fetch_dashboard_stats()
+        if stale:
+            st.warning("Não foi possível atualizar os dados. Exibindo os últimos valores carregados.")
 
-        col1, col2, col3, col4 = st.columns(4)
-        with col1:
-            st.metric("Total de Relatórios", stats['total_reports'])
-        with col2:
-            st.metric("Total de Empresas", stats['total_companies'])
-        with col3:
-            st.metric("Total de Usuários", stats['total_users'])
-        with col4:
-            st.metric("Em Andamento", stats['pending_reports'])
+        dashboard_metrics_fragment()
 
         st.markdown("---")
 
@@ -793,34 +1506,129 @@ def dashboard_page():
         else:
             st.info("Sem dados dos últimos 30 dias")
 
-        conn.close()
     except Exception as e:
         st.error("Erro ao carregar dashboard")
         print(f"Erro: {e}")
 
 
-def reports_page():
-    """Página de gerenciamento de relatórios"""
-    st.title("📄 Gerenciamento de Relatórios")
+def get_selected_report(report_id: int) -> dict:
+    """Obtém os dados do relatório selecionado, reaproveitando-os entre as ações.
 
-    tab1, tab2 = st.tabs(["Visualizar Relatórios", "Gerar Novo Relatório"])
+    Só relatórios em estado final ficam em cache na sessão; os demais ainda
+    podem ter o status alterado pelo polling e são sempre relidos.
+    """
+    cached = st.session_state.selected_report
+    if cached and cached['id'] == report_id and cached['status'] in FINAL_REPORT_STATUSES:
+        return cached
 
-    with tab1:
+    with db_conn() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT r.id, r.company_id, r.user_id, r.start_date, r.end_date, r.file_path,
+                   r.status, r.flow_run_id, r.generated_at, r.created_at, r.updated_at,
+                   c.name as empresa, u.name as usuario
+            FROM reports r
+            JOIN company c ON r.company_id = c.id
+            JOIN users u ON r.user_id = u.id
+            WHERE r.id = %s
+        """, (report_id,))
+        row = cur.fetchone()
+        cur.close()
+
+    st.session_state.selected_report = dict(row) if row else None
+    return st.session_state.selected_report
+
+
+def show_report_status(watched: dict):
+    if watched['status'] == 'completed':
+        st.success(f"✅ Relatório {watched['id']} concluído")
+    elif watched['status'] in FINAL_REPORT_STATUSES:
+        st.error(f"❌ Relatório {watched['id']} finalizado com status: {watched['status']}")
+    else:
+        st.info(f"⚙️ Relatório {watched['id']}: {watched['status']}")
+
+
+@st.fragment(run_every=2)
+def report_status_fragment():
+    """Acompanha ao vivo o status do último relatório acionado na sessão
+
+    O status chega pela fila do LISTEN/NOTIFY; a tabela só é relida na
+    primeira execução e depois de cada reconexão do LISTEN, quando
+    notificações podem ter se perdido.
+    """
+    watched = st.session_state.watched_report
+
+    channel = get_report_status_channels().get(watched['id']) or register_report_listener(watched['id'])
+    generation = get_listener_generation()['value']
+    if watched.get('generation') != generation:
+        watched['generation'] = generation
         try:
-            conn = get_db_connection()
+            with db_conn() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT status FROM reports WHERE id = %s", (watched['id'],))
+                row = cur.fetchone()
+                cur.close()
+            if row:
+                watched['status'] = row[0]
+        except Exception as e:
+            print(f"Erro ao consultar status do relatório: {e}")
+    while not channel.empty():
+        watched['status'] = channel.get_nowait()
+
+    if watched['status'] in FINAL_REPORT_STATUSES:
+        # Status final: para de reexecutar o fragmento e exibe o resultado fora dele
+        unregister_report_listener(watched['id'])
+        st.rerun()
+
+    show_report_status(watched)
+
+
+def reports_filter_sql(company_filter, status_filter: str, date_filter: date) -> tuple:
+    """Monta o WHERE da listagem de relatórios; retorna (sql, parâmetros)"""
+    where = "r.created_at >= %s"
+    params = [date_filter]
+
+    if company_filter != "Todos":
+        where += " AND r.company_id = %s"
+        params.append(company_filter)
 
-            # Filtros
+    if status_filter != "Todos":
+        where += " AND r.status = %s"
+        params.append(status_filter)
+
+    return where, params
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def count_reports(company_filter, status_filter: str, date_filter: date) -> int:
+    """Total de relatórios do filtro; mudar só de página não refaz o COUNT"""
+    where, params = reports_filter_sql(company_filter, status_filter, date_filter)
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # company e users são FKs obrigatórias: o JOIN não altera a contagem
+        cur.execute(f"SELECT COUNT(*) FROM reports r WHERE {where}", params)
+        total = cur.fetchone()[0]
+        cur.close()
+    return total
+
+
+@st.fragment
+def reports_list_fragment(company_names: dict):
+    """Filtros, listagem e ações de relatórios; interações aqui reexecutam só este bloco"""
+    try:
+        # Filtros em um form: alterar vários campos gera um único rerun, no "Aplicar"
+        with st.form("report_filters", border=False):
             col1, col2, col3, col4 = st.columns(4)
 
             with col1:
-                companies = pd.read_sql_query("SELECT id, name FROM company ORDER BY name", conn)
-                company_filter = st.selectbox("Empresa", ["Todos"] + companies['name'].tolist())
+                company_filter = st.selectbox(
+                    "Empresa",
+                    ["Todos"] + list(company_names),
+                    format_func=lambda x: company_names.get(x, x)
+                )
 
             with col2:
-                status_filter = st.selectbox(
-                    "Status",
-                    ["Todos", "pending", "scheduled", "running", "completed", "failed", "timeout"]
-                )
+                status_filter = st.selectbox("Status", REPORT_STATUS_FILTERS)
 
             with col3:
                 date_filter = st.date_input(
@@ -830,189 +1638,221 @@ def reports_page():
                 )
 
             with col4:
-                if st.button("🔄 Atualizar", use_container_width=True):
-                    st.rerun()
-
-            # Query base com parâmetros seguros
-            query = """
-                SELECT r.id, c.name as empresa, u.name as usuario,
-                       r.start_date as data_inicio, r.end_date as data_fim,
-                       r.status, r.created_at as criado_em, r.file_path
-                FROM reports r
-                JOIN company c ON r.company_id = c.id
-                JOIN users u ON r.user_id = u.id
-                WHERE r.created_at >= %s
-            """
-            params = [date_filter]
+                st.form_submit_button("✅ Aplicar", use_container_width=True)
+                if st.form_submit_button("🔄 Atualizar", use_container_width=True):
+                    count_reports.clear()
+
+        # Total em cache por filtro; a página vem de uma consulta separada
+        total_reports = count_reports(company_filter, status_filter, date_filter)
+        total_pages = max(1, (total_reports + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+
+        # Paginação por chave (keyset): pilha com o cursor de início de cada página visitada
+        if st.session_state.get('reports_filters') != (company_filter, status_filter, date_filter):
+            st.session_state.reports_filters = (company_filter, status_filter, date_filter)
+            st.session_state.reports_cursors = [None]
+
+        cursors = st.session_state.reports_cursors
+        current_page = len(cursors)
+
+        where, params = reports_filter_sql(company_filter, status_filter, date_filter)
+        if cursors[-1]:
+            where += " AND (r.created_at, r.id) < (%s, %s)"
+            params.extend(cursors[-1])
+
+        query = f"""
+            SELECT r.id, c.name as empresa, u.name as usuario,
+                   r.start_date as data_inicio, r.end_date as data_fim,
+                   r.status, r.created_at as criado_em, r.file_path
+            FROM reports r
+            JOIN company c ON r.company_id = c.id
+            JOIN users u ON r.user_id = u.id
+            WHERE {where}
+            ORDER BY r.created_at DESC, r.id DESC
+            LIMIT %s
+        """
+        with db_conn() as conn:
+            reports_df = read_sql(conn, query, params + [ITEMS_PER_PAGE])
 
-            if company_filter != "Todos":
-                query += " AND c.name = %s"
-                params.append(company_filter)
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if current_page > 1 and st.button("⏮️ Primeira"):
+                st.session_state.reports_cursors = [None]
+                st.rerun(scope="fragment")
+        with col2:
+            if current_page > 1 and st.button("◀️ Anterior"):
+                cursors.pop()
+                st.rerun(scope="fragment")
+        with col3:
+            if len(reports_df) == ITEMS_PER_PAGE and current_page < total_pages and st.button("Próxima ▶️"):
+                last = reports_df.iloc[-1]
+                cursors.append((last['criado_em'].to_pydatetime(), int(last['id'])))
+                st.rerun(scope="fragment")
+
+        if not reports_df.empty:
+            reports_df['status'] = reports_df['status'].map(STATUS_LABELS).fillna('❓ ' + reports_df['status'])
+            st.dataframe(
+                reports_df,
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    'status': st.column_config.TextColumn("Status"),
+                    'criado_em': st.column_config.DatetimeColumn("Criado em", format="DD/MM/YYYY HH:mm")
+                }
+            )
+            st.info(f"Mostrando {len(reports_df)} de {total_reports} | Página {current_page} de {total_pages}")
 
-            if status_filter != "Todos":
-                query += " AND r.status = %s"
-                params.append(status_filter)
+            # Ações
+            st.subheader("Ações de Relatório")
+            report_id = st.number_input("ID do Relatório", min_value=1, step=1)
 
-            # Count total
-            count_query = f"SELECT COUNT(*) as total FROM ({query}) as subquery"
-            total_reports = pd.read_sql_query(count_query, conn, params=params)['total'][0]
+            col1, col2, col3, col4 = st.columns(4)
 
-            # Paginação
-            total_pages = max(1, (total_reports + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+            with col1:
+                if st.button("Ver Detalhes"):
+                    report = get_selected_report(report_id)
+                    if report:
+                        st.json(report)
+                    else:
+                        st.error("Relatório não encontrado")
 
-            col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
-                current_page = st.number_input(
-                    f"Página (1-{total_pages})",
-                    min_value=1,
-                    max_value=total_pages,
-                    value=min(st.session_state.current_page, total_pages),
-                    key='page_selector'
-                )
-                st.session_state.current_page = current_page
-
-            # Query com paginação
-            offset = (current_page - 1) * ITEMS_PER_PAGE
-            query += f" ORDER BY r.created_at DESC LIMIT %s OFFSET %s"
-            params.extend([ITEMS_PER_PAGE, offset])
-
-            reports_df = pd.read_sql_query(query, conn, params=params)
-
-            if not reports_df.empty:
-                def format_status(status):
-                    icons = {
-                        'pending': '⏳', 'scheduled': '📅', 'running': '⚙️',
-                        'completed': '✅', 'failed': '❌', 'timeout': '⏰'
-                    }
-                    return f"{icons.get(status, '❓')} {status}"
-
-                reports_df['status'] = reports_df['status'].apply(format_status)
-                st.dataframe(reports_df, use_container_width=True)
-                st.info(f"Mostrando {len(reports_df)} de {total_reports} | Página {current_page} de {total_pages}")
-
-                # Ações
-                st.subheader("Ações de Relatório")
-                report_id = st.number_input("ID do Relatório", min_value=1, step=1)
-
-                col1, col2, col3, col4 = st.columns(4)
-
-                with col1:
-                    if st.button("Ver Detalhes"):
-                        report = pd.read_sql_query("""
-                            SELECT r.*, c.name as empresa, u.name as usuario
-                            FROM reports r
-                            JOIN company c ON r.company_id = c.id
-                            JOIN users u ON r.user_id = u.id
-                            WHERE r.id = %s
-                        """, conn, params=(report_id,))
-                        if not report.empty:
-                            st.json(report.to_dict('records')[0])
-                        else:
-                            st.error("Relatório não encontrado")
-
-                with col2:
-                    if st.button("👁️ Preview"):
-                        report = pd.read_sql_query(
-                            "SELECT status, file_path FROM reports WHERE id = %s",
-                            conn, params=(report_id,)
-                        )
-                        if not report.empty:
-                            status = report['status'].values[0].split()[-1]
-                            file_path = report['file_path'].values[0]
-
-                            if status == 'completed' and file_path:
-                                if check_file_exists_in_s3(file_path):
-                                    with st.spinner('Carregando preview...'):
-                                        content = download_report_from_s3(file_path)
-                                        if content:
-                                            images, total = generate_pdf_preview(content)
-                                            if images:
-                                                st.success(f"📄 Preview (Total: {total} páginas)")
-                                                for idx, img in enumerate(images):
-                                                    st.image(img, caption=f"Página {idx + 1}",
-                                                             use_container_width=True)
-                                            else:
-                                                st.error("Erro ao gerar preview")
-                                        else:
-                                            st.error("Erro ao baixar arquivo")
-                                else:
-                                    st.error("Arquivo não encontrado")
-                            else:
-                                st.warning(f"Relatório não completo. Status: {status}")
+                if st.button("👁️ Preview"):
+                    report = get_selected_report(report_id)
+                    if report:
+                        status = report['status']
+                        file_path = report['file_path']
+
+                        if status == 'completed' and file_path:
+                            try:
+                                st.session_state.preview_file = (file_path, get_report_etag(file_path))
+                                st.session_state.preview_page = 1
+                            except FileNotFoundError:
+                                st.error("Arquivo não encontrado")
+                            except ValueError:
+                                st.error("Erro ao consultar arquivo")
                         else:
-                            st.error("Relatório não encontrado")
+                            st.warning(f"Relatório não completo. Status: {status}")
+                    else:
+                        st.error("Relatório não encontrado")
 
-                with col3:
-                    if st.button("📥 Baixar"):
-                        report = pd.read_sql_query(
-                            "SELECT status, file_path FROM reports WHERE id = %s",
-                            conn, params=(report_id,)
-                        )
-                        if not report.empty:
-                            status = report['status'].values[0].split()[-1]
-                            file_path = report['file_path'].values[0]
-
-                            if status == 'completed' and file_path:
-                                if check_file_exists_in_s3(file_path):
-                                    content = download_report_from_s3(file_path)
-                                    if content:
-                                        file_name = file_path.split('/')[-1]
-                                        st.download_button(
-                                            label="💾 Clique para baixar",
-                                            data=content,
-                                            file_name=file_name,
-                                            mime="application/pdf",
-                                            use_container_width=True
-                                        )
-                                        log_audit(
-                                            st.session_state.user['id'],
-                                            'download_report',
-                                            report_id,
-                                            {'file_path': file_path}
-                                        )
-                                        st.success("✅ Pronto!")
-                                    else:
-                                        st.error("Erro ao baixar")
+            with col3:
+                if st.button("📥 Baixar"):
+                    report = get_selected_report(report_id)
+                    if report:
+                        status = report['status']
+                        file_path = report['file_path']
+
+                        if status == 'completed' and file_path:
+                            try:
+                                etag = get_report_etag(file_path)
+                            except FileNotFoundError:
+                                etag = None
+                                st.error("Arquivo não encontrado")
+                            except ValueError:
+                                etag = None
+                                st.error("Erro ao consultar arquivo")
+                            if etag:
+                                try:
+                                    content = load_report_bytes(file_path, etag)
+                                except ValueError:
+                                    content = None
+                                if content:
+                                    file_name = file_path.split('/')[-1]
+                                    st.download_button(
+                                        label="💾 Clique para baixar",
+                                        data=content,
+                                        file_name=file_name,
+                                        mime="application/pdf",
+                                        use_container_width=True
+                                    )
+                                    log_audit(
+                                        st.session_state.user['id'],
+                                        'download_report',
+                                        report_id,
+                                        {'file_path': file_path}
+                                    )
+                                    st.success("✅ Pronto!")
                                 else:
-                                    st.error("Arquivo não encontrado")
-                            else:
-                                st.warning(f"Status: {status}")
+                                    st.error("Erro ao baixar")
                         else:
-                            st.error("Relatório não encontrado")
+                            st.warning(f"Status: {status}")
+                    else:
+                        st.error("Relatório não encontrado")
 
-                with col4:
-                    if st.button("🗑️ Excluir"):
-                        if st.session_state.user['role'] == 'admin':
+            with col4:
+                if st.button("🗑️ Excluir"):
+                    if st.session_state.user['role'] == 'admin':
+                        with db_conn() as conn:
                             cur = conn.cursor()
                             cur.execute("DELETE FROM reports WHERE id = %s", (report_id,))
                             conn.commit()
                             cur.close()
-                            log_audit(st.session_state.user['id'], 'delete_report', report_id)
-                            st.success("Relatório excluído!")
-                            st.rerun()
-                        else:
-                            st.error("Apenas administradores")
-            else:
-                st.info("Nenhum relatório encontrado")
+                        st.session_state.selected_report = None
+                        count_reports.clear()
+                        log_audit(st.session_state.user['id'], 'delete_report', report_id)
+                        st.toast("Relatório excluído!", icon="🗑️")
+                        st.rerun(scope="fragment")
+                    else:
+                        st.error("Apenas administradores")
+
+            # Preview sob demanda: só a página escolhida é baixada/rasterizada
+            if st.session_state.preview_file:
+                file_path, etag = st.session_state.preview_file
+                with st.spinner('Carregando preview...'):
+                    try:
+                        image, total = load_pdf_preview(
+                            file_path, etag, st.session_state.get('preview_page', 1) - 1
+                        )
+                    except ValueError as e:
+                        image, total = None, 0
+                        st.error(str(e))
+
+                if image is not None:
+                    col1, col2 = st.columns([3, 1])
+                    with col1:
+                        st.success(f"📄 Preview de {file_path.split('/')[-1]} (Total: {total} páginas)")
+                    with col2:
+                        if st.button("✖️ Fechar preview", use_container_width=True):
+                            st.session_state.preview_file = None
+                            st.rerun(scope="fragment")
+                    page = st.number_input(f"Página do preview (1-{total})", min_value=1,
+                                           max_value=total, key='preview_page')
+                    st.image(image, caption=f"Página {page}", use_container_width=True)
+        else:
+            st.info("Nenhum relatório encontrado")
 
-            conn.close()
-        except Exception as e:
-            st.error("Erro ao carregar relatórios")
-            print(f"Erro: {e}")
+    except Exception as e:
+        st.error("Erro ao carregar relatórios")
+        print(f"Erro: {e}")
+
+
+def reports_page():
+    """Página de gerenciamento de relatórios"""
+    st.title("📄 Gerenciamento de Relatórios")
+
+    tab1, tab2 = st.tabs(["Visualizar Relatórios", "Gerar Novo Relatório"])
+
+    # {id: nome} montado uma vez por rerun e usado pelas duas abas
+    try:
+        company_names = dict(load_companies())
+    except Exception as e:
+        st.error("Erro ao carregar empresas")
+        print(f"Erro: {e}")
+        return
+
+    with tab1:
+        reports_list_fragment(company_names)
 
     with tab2:
         st.subheader("Gerar Novo Relatório")
         try:
-            conn = get_db_connection()
-            companies = pd.read_sql_query("SELECT id, name FROM company ORDER BY name", conn)
-
-            if companies.empty:
+            if not company_names:
                 st.warning("Adicione empresas primeiro!")
             else:
                 company_id = st.selectbox(
                     "Empresa",
-                    companies['id'].tolist(),
-                    format_func=lambda x: companies[companies['id'] == x]['name'].values[0]
+                    list(company_names),
+                    format_func=company_names.get
                 )
 
                 col1, col2 = st.columns(2)
@@ -1026,21 +1866,9 @@ def reports_page():
                         st.error("Data fim deve ser maior que data início")
                         return
 
-                    cur = conn.cursor()
-                    company = companies[companies['id'] == company_id]['name'].values[0]
+                    company = company_names[company_id]
                     report_name = f'{sanitize_input(company.lower())}_report_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
 
-                    cur.execute("""
-                        INSERT INTO reports (company_id, user_id, start_date, end_date, status, file_path, generated_at)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        RETURNING id
-                    """, (company_id, st.session_state.user['id'], start_date, end_date,
-                          'pending', report_name, datetime.now()))
-
-                    report_id = cur.fetchone()[0]
-                    conn.commit()
-                    cur.close()
-
                     flow_params = {
                         'company': company,
                         'start_date': str(start_date),
@@ -1048,19 +1876,30 @@ def reports_page():
                         'report_name': report_name
                     }
 
+                    # Aciona o flow primeiro: o relatório é gravado uma única vez já com o resultado
                     with st.spinner('Acionando geração...'):
                         result = trigger_prefect_flow(flow_params)
 
-                    if result['success']:
+                    with db_conn() as conn:
                         cur = conn.cursor()
                         cur.execute("""
-                            UPDATE reports 
-                            SET flow_run_id = %s, status = %s
-                            WHERE id = %s
-                        """, (result['flow_run_id'], 'scheduled', report_id))
+                            INSERT INTO reports (company_id, user_id, start_date, end_date, status, file_path,
+                                                 flow_run_id, generated_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                            RETURNING id
+                        """, (company_id, st.session_state.user['id'], start_date, end_date,
+                              'scheduled' if result['success'] else 'failed', report_name,
+                              result.get('flow_run_id'), datetime.now()))
+
+                        report_id = cur.fetchone()[0]
+                        if result['success']:
+                            # Registra antes do commit para não perder nenhum NOTIFY do relatório
+                            register_report_listener(report_id)
                         conn.commit()
                         cur.close()
+                    count_reports.clear()
 
+                    if result['success']:
                         log_audit(
                             st.session_state.user['id'],
                             'generate_report',
@@ -1069,19 +1908,51 @@ def reports_page():
                         )
 
                         st.success(f"✅ Relatório acionado! ID: {report_id}")
-                        start_polling_thread(report_id, result['flow_run_id'])
+                        wake_status_poller()
+                        clear_watched_report()
+                        st.session_state.watched_report = {'id': report_id, 'status': 'scheduled', 'generation': None}
                     else:
-                        cur = conn.cursor()
-                        cur.execute("UPDATE reports SET status = %s WHERE id = %s", ('failed', report_id))
-                        conn.commit()
-                        cur.close()
                         st.error(f"❌ {result['message']}")
 
-            conn.close()
         except Exception as e:
             st.error("Erro ao gerar relatório")
             print(f"Erro: {e}")
 
+        watched = st.session_state.watched_report
+        if watched:
+            if watched['status'] in FINAL_REPORT_STATUSES:
+                show_report_status(watched)
+            else:
+                report_status_fragment()
+
+
+@st.fragment
+def companies_list_fragment():
+    """Listagem paginada de empresas; trocar de página reexecuta só este bloco"""
+    try:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM company")
+            total_companies = cur.fetchone()[0]
+            cur.close()
+
+        current_page, total_pages = page_selector(total_companies, 'companies_page_selector')
+        with db_conn() as conn:
+            companies = read_sql(conn, """
+                SELECT id, name as nome, address as endereco, created_at as criado_em
+                FROM company
+                ORDER BY name
+                LIMIT %s OFFSET %s
+            """, (ITEMS_PER_PAGE, (current_page - 1) * ITEMS_PER_PAGE))
+        if not companies.empty:
+            st.dataframe(companies, use_container_width=True)
+            st.info(f"Mostrando {len(companies)} de {total_companies} | Página {current_page} de {total_pages}")
+        else:
+            st.info("Nenhuma empresa encontrada")
+    except Exception as e:
+        st.error("Erro ao carregar empresas")
+        print(f"Erro: {e}")
+
 
 def companies_page():
     """Página de gerenciamento de empresas"""
@@ -1094,20 +1965,7 @@ def companies_page():
     tab1, tab2 = st.tabs(["Visualizar", "Adicionar"])
 
     with tab1:
-        try:
-            conn = get_db_connection()
-            companies = pd.read_sql_query(
-                "SELECT id, name as nome, address as endereco, created_at as criado_em FROM company ORDER BY name",
-                conn
-            )
-            if not companies.empty:
-                st.dataframe(companies, use_container_width=True)
-            else:
-                st.info("Nenhuma empresa encontrada")
-            conn.close()
-        except Exception as e:
-            st.error("Erro ao carregar empresas")
-            print(f"Erro: {e}")
+        companies_list_fragment()
 
     with tab2:
         st.subheader("Adicionar Nova Empresa")
@@ -1123,16 +1981,20 @@ def companies_page():
             address = sanitize_input(address, 500)
 
             try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute(
-                    "INSERT INTO company (name, address) VALUES (%s, %s) RETURNING id",
-                    (name, address)
-                )
-                company_id = cur.fetchone()[0]
-                conn.commit()
-                cur.close()
-                conn.close()
+                with db_conn() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        "INSERT INTO company (name, address) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING RETURNING id",
+                        (name, address)
+                    )
+                    row = cur.fetchone()
+                    conn.commit()
+                    cur.close()
+
+                if not row:
+                    st.error("Empresa já existe")
+                    return
+                company_id = row[0]
 
                 log_audit(
                     st.session_state.user['id'],
@@ -1141,10 +2003,9 @@ def companies_page():
                     {'name': name}
                 )
 
-                st.success("Empresa adicionada!")
+                load_companies.clear()
+                st.toast("Empresa adicionada!", icon="✅")
                 st.rerun()
-            except psycopg2.IntegrityError:
-                st.error("Empresa já existe")
             except Exception as e:
                 st.error("Erro ao adicionar empresa")
                 print(f"Erro: {e}")
@@ -1162,18 +2023,26 @@ def users_page():
 
     with tab1:
         try:
-            conn = get_db_connection()
-            users = pd.read_sql_query("""
-                SELECT id, name as nome, email, role as funcao, 
-                       created_at as criado_em 
-                FROM users 
-                ORDER BY created_at DESC
-            """, conn)
+            with db_conn() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT COUNT(*) FROM users")
+                total_users = cur.fetchone()[0]
+                cur.close()
+
+            current_page, total_pages = page_selector(total_users, 'users_page_selector')
+            with db_conn() as conn:
+                users = read_sql(conn, """
+                    SELECT id, name as nome, email, role as funcao, 
+                           created_at as criado_em 
+                    FROM users 
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s OFFSET %s
+                """, (ITEMS_PER_PAGE, (current_page - 1) * ITEMS_PER_PAGE))
             if not users.empty:
                 st.dataframe(users, use_container_width=True)
+                st.info(f"Mostrando {len(users)} de {total_users} | Página {current_page} de {total_pages}")
             else:
                 st.info("Nenhum usuário encontrado")
-            conn.close()
         except Exception as e:
             st.error("Erro ao carregar usuários")
             print(f"Erro: {e}")
@@ -1184,7 +2053,7 @@ def users_page():
         email = st.text_input("Email", max_chars=255)
         password = st.text_input("Senha", type="password", max_chars=100)
         password_confirm = st.text_input("Confirmar Senha", type="password", max_chars=100)
-        role = st.selectbox("Função", ["admin", "user", "viewer"])
+        role = st.selectbox("Função", USER_ROLES)
 
         if st.button("Adicionar Usuário"):
             if not all([name, email, password, password_confirm]):
@@ -1207,18 +2076,25 @@ def users_page():
             email = sanitize_input(email, 255)
 
             try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                password_hash = hash_password(password)
+                # Hash fora do pool de conexões e em threads próprias (bcrypt libera o GIL)
+                with st.spinner('Gerando hash da senha...'):
+                    password_hash = get_hash_executor().submit(hash_password, password).result()
 
-                cur.execute(
-                    "INSERT INTO users (name, email, password_hash, role) VALUES (%s, %s, %s, %s) RETURNING id",
-                    (name, email, password_hash, role)
-                )
-                user_id = cur.fetchone()[0]
-                conn.commit()
-                cur.close()
-                conn.close()
+                with db_conn() as conn:
+                    cur = conn.cursor()
+                    cur.execute(
+                        "INSERT INTO users (name, email, password_hash, role) VALUES (%s, %s, %s, %s) "
+                        "ON CONFLICT (email) DO NOTHING RETURNING id",
+                        (name, email, password_hash, role)
+                    )
+                    row = cur.fetchone()
+                    conn.commit()
+                    cur.close()
+
+                if not row:
+                    st.error("Email já existe")
+                    return
+                user_id = row[0]
 
                 log_audit(
                     st.session_state.user['id'],
@@ -1227,76 +2103,95 @@ def users_page():
                     {'name': name, 'email': email, 'role': role}
                 )
 
-                st.success("Usuário adicionado!")
+                load_users.clear()
+                st.toast("Usuário adicionado!", icon="✅")
                 st.rerun()
-            except psycopg2.IntegrityError:
-                st.error("Email já existe")
             except Exception as e:
                 st.error("Erro ao adicionar usuário")
                 print(f"Erro: {e}")
 
 
-def audit_logs_page():
-    """Página de logs de auditoria"""
-    st.title("📋 Logs de Auditoria")
-
-    if st.session_state.user['role'] != 'admin':
-        st.warning("Apenas administradores podem visualizar logs")
-        return
-
+@st.fragment
+def audit_logs_fragment():
+    """Filtros e páginas dos logs; interações aqui reexecutam só este bloco"""
     try:
-        conn = get_db_connection()
-
         col1, col2 = st.columns(2)
 
+        # Seleção vazia = todos
         with col1:
-            users = pd.read_sql_query("SELECT id, name FROM users ORDER BY name", conn)
-            user_filter = st.selectbox("Usuário", ["Todos"] + users['name'].tolist())
-
-        with col2:
-            action_filter = st.selectbox(
-                "Ação",
-                ["Todos", "login", "logout", "generate_report", "download_report",
-                 "add_company", "add_user", "delete_report"]
+            user_names = dict(load_users())
+            user_filter = st.multiselect(
+                "Usuários",
+                list(user_names),
+                format_func=user_names.get,
+                placeholder="Todos"
             )
 
-        query = """
-            SELECT a.id, u.name as usuario, a.action as acao,
-                   a.target_id, a.details as detalhes,
-                   a.ip_address as ip, a.created_at as data_hora
-            FROM audit_logs a
-            JOIN users u ON a.user_id = u.id
-            WHERE 1=1
-        """
-        params = []
-
-        if user_filter != "Todos":
-            query += " AND u.name = %s"
-            params.append(user_filter)
-
-        if action_filter != "Todos":
-            query += " AND a.action = %s"
-            params.append(action_filter)
-
-        query += " ORDER BY a.created_at DESC LIMIT 100"
-
-        if params:
-            logs = pd.read_sql_query(query, conn, params=params)
-        else:
-            logs = pd.read_sql_query(query, conn)
+        with col2:
+            action_filter = st.multiselect("Ações", AUDIT_ACTIONS, placeholder="Todos")
+
+        # Paginação por chave (keyset): continua a partir do último registro exibido
+        if st.session_state.get('audit_logs_filters') != (user_filter, action_filter):
+            st.session_state.audit_logs_filters = (user_filter, action_filter)
+            st.session_state.audit_logs_cursor = None
+
+        cursor = st.session_state.audit_logs_cursor
+        cursor_at, cursor_id = cursor or (None, None)
+
+        # Consulta única: filtros ausentes chegam como NULL e o Postgres descarta o predicado
+        with db_conn() as conn:
+            logs = read_sql(conn, """
+                SELECT a.id, u.name as usuario, a.action as acao,
+                       a.target_id, a.details as detalhes,
+                       a.ip_address as ip, a.created_at as data_hora
+                FROM audit_logs a
+                JOIN users u ON a.user_id = u.id
+                WHERE (%(users)s::integer[] IS NULL OR a.user_id = ANY(%(users)s))
+                  AND (%(actions)s::text[] IS NULL OR a.action = ANY(%(actions)s))
+                  AND (%(cursor_at)s::timestamp IS NULL OR (a.created_at, a.id) < (%(cursor_at)s, %(cursor_id)s))
+                ORDER BY a.created_at DESC, a.id DESC
+                LIMIT %(limit)s
+            """, {
+                'users': user_filter or None,
+                'actions': action_filter or None,
+                'cursor_at': cursor_at,
+                'cursor_id': cursor_id,
+                'limit': AUDIT_LOGS_PER_PAGE
+            })
 
         if not logs.empty:
             st.dataframe(logs, use_container_width=True)
-            st.info(f"Mostrando últimos {len(logs)} registros")
+            st.info(f"Mostrando {len(logs)} registros")
         else:
             st.info("Nenhum log encontrado")
 
-        conn.close()
+        col1, col2 = st.columns(2)
+        with col1:
+            if cursor and st.button("⏮️ Mais recentes"):
+                st.session_state.audit_logs_cursor = None
+                st.rerun(scope="fragment")
+        with col2:
+            if len(logs) == AUDIT_LOGS_PER_PAGE and st.button("Mais antigos ▶️"):
+                last = logs.iloc[-1]
+                st.session_state.audit_logs_cursor = (last['data_hora'].to_pydatetime(), int(last['id']))
+                st.rerun(scope="fragment")
+
     except Exception as e:
         st.error("Erro ao carregar logs")
         print(f"Erro: {e}")
 
 
+def audit_logs_page():
+    """Página de logs de auditoria"""
+    st.title("📋 Logs de Auditoria")
+
+    if st.session_state.user['role'] != 'admin':
+        st.warning("Apenas administradores podem visualizar logs")
+        return
+
+    audit_logs_fragment()
+
+
 # ============================================================================
 # MAIN
 # ============================================================================
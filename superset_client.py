@@ -1,50 +1,129 @@
+import asyncio
+import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-from pprint import pprint
-from urllib.parse import urlparse, urlunparse
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
 
 import boto3
+from botocore.config import Config
 import duckdb
-import requests
-import json
+import httpx
+import orjson
 
 from openai import OpenAI
+from PIL import Image, ImageDraw, ImageFont
 
 from generate_report import generate_report_pdf
 
+logger = logging.getLogger(__name__)
+
+SUPERSET_URL = "http://superset:8088"
+CHARTS_MAPPING = {
+    'total_vencidos': 8,
+    'total_visitas': 9,
+    'total_nao_conformidades': 10,
+    'media_nota': 11,
+    'conformidade_por_unidade': 12,
+    'media_nota_por_unidade': 13,
+    'porcentagem_conformidade': 14,
+    'conformidade_por_area': 15,
+    'itens_nao_conformes': 16,
+    'vencidor_por_loja': 17
+}
+
+SCREENSHOT_POLL_DELAYS = (0.5, 1, 2, 4, 8, 15)
+SUPERSET_TIMEOUT = 60
+SUPERSET_POOL_SIZE = 20
+AUTH_TOKEN_TTL = 300
+S3_UPLOAD_WORKERS = 8
+S3_MAX_POOL_CONNECTIONS = 32
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+COMMENTS_LIMIT = 2000
+PROMPT_MAX_CHARS = 28_000 * 4
+REPLACED_FILTER_SUBJECTS = frozenset({'unidade', 'data_inicial'})
+RENDERED_VIZ_TYPES = frozenset({'big_number_total'})
+DEFAULT_NUMBER_FORMATS = frozenset({None, '', 'SMART_NUMBER'})
+SI_PREFIXES = ((1e12, 'T'), (1e9, 'G'), (1e6, 'M'), (1e3, 'k'))
+BIG_NUMBER_SIZE = (800, 400)
+BIG_NUMBER_FONT = "Poppins-Bold.ttf"
+BIG_NUMBER_FONT_SIZE = 160
+
+PROMPT_TEMPLATE = '''
+    You are a food safety and data analyst specialist to LM food safety consultant.
+    LM Segurança Alimentar is a brazilian company that give consultant to restaurants and supermarkets about food safety.
+    It conducts monitoring, audits, and training to ensure that products are stored, handled, and displayed in accordance
+    with health regulations. In addition, it verifies temperatures, expiration dates, and the hygiene of equipment
+    and employees, preventing contamination and reducing health risks to consumers.
+    Your task is to analyse previous visits to establishments and give summarized version to the client.
+
+    # Instructions:
+    1. Synthesize key findings into a cohesive narrative (max 100 words)
+    2. Highlight recurring issues or patterns across visits
+    3. Write in paragraph format only - no lists or bullet points
+    4. Use Brazilian Portuguese (pt-BR)
+    5. Focus on actionable insights: non-compliances, critical temperature deviations, hygiene issues, and expired products
+    6. Do not add conclusions, recommendations, or extra commentary beyond the data summary
+
+    # Guardrails:
+    - ONLY analyze data provided in the Visit Data section below
+    - DO NOT invent, assume, or extrapolate information not present in the data
+    - Maintain professional, neutral tone - avoid alarmist or dismissive language
+
+    # Visit Date Range:
+    Start date: {start_date}
+    End date: {end_date}
+    
+    # Visit Data:
+    {dataframe}
+
+    Output the summary in pt-BR as a single paragraph.
+    '''
+
+
+@lru_cache(maxsize=4)
+def fetch_auth_token(url, username, password, epoch):
+    login_resp = httpx.post(f"{url}/api/v1/security/login", timeout=SUPERSET_TIMEOUT, json={
+        "username": username,
+        "password": password,
+        "provider": "db"
+    })
+    access_token = login_resp.json()["access_token"]
+    return {"Authorization": f"Bearer {access_token}"}
+
+
+def get_auth_token(url, username, password):
+    return fetch_auth_token(url, username, password, int(time.time() // AUTH_TOKEN_TTL))
+
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    return boto3.client(
+        "s3",
+        endpoint_url=os.getenv('MINIO_ENDPOINT'),
+        aws_access_key_id=os.getenv('MINIO_ACCESS_KEY'),
+        aws_secret_access_key=os.getenv('MINIO_SECRET_KEY'),
+        region_name="us-east-1",
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                      retries={'max_attempts': 3, 'mode': 'adaptive'}),
+    )
+
+
+def upload_files(s3, files, bucket):
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=min(S3_UPLOAD_WORKERS, len(files))) as executor:
+        list(executor.map(lambda item: s3.upload_file(item[0], bucket, item[1]), files.items()))
+
 
 class UpdateChart:
-    def __init__(self, base_url, username, password, charts, company):
+    def __init__(self, base_url, charts, company):
         self.base_url = base_url
-        self.username = username
-        self.password = password
         self.charts = charts
         self.company = company
-
-    @staticmethod
-    def get_auth_token(url, username, password):
-        login_resp = requests.post(f"{url}/api/v1/security/login", json={
-            "username": username,
-            "password": password,
-            "provider": "db"
-        })
-        access_token = login_resp.json()["access_token"]
-        return {"Authorization": f"Bearer {access_token}"}
-
-    @staticmethod
-    def get_chart(chart_id, headers, url):
-        chart_resp = requests.get(f"{url}/api/v1/chart/{chart_id}", headers=headers)
-        chart_data = chart_resp.json()["result"]
-        params = json.loads(chart_data["params"])
-        query_context = json.loads(chart_data["query_context"])
-        return params, chart_data, query_context
-
-    @staticmethod
-    def add_filter(chart_filter, company):
-        new_filter = chart_filter.copy()
-        new_filter = list(filter(lambda x: x['subject'] not in ['unidade', 'data_inicial'], new_filter))
-        new_filter.append(
+        self.extra_filters = [
             {'clause': 'WHERE',
              'comparator': 'Last week',
              'datasourceWarning': False,
@@ -52,77 +131,145 @@ class UpdateChart:
              'isExtra': False, 'isNew': False,
              'operator': 'TEMPORAL_RANGE',
              'sqlExpression': None,
-             'subject': 'data_inicial'}
-        )
-        new_filter.append({
-            "expressionType": "SIMPLE",
-            "subject": "unidade",
-            "operator": "IN",
-            "comparator": [company],
-            "clause": "WHERE",
-            "sqlExpression": None
-        })
-
-        return new_filter
+             'subject': 'data_inicial'},
+            {"expressionType": "SIMPLE",
+             "subject": "unidade",
+             "operator": "IN",
+             "comparator": [company],
+             "clause": "WHERE",
+             "sqlExpression": None}
+        ]
+        self.query_filters = [
+            {"col": "data_inicial", "op": "TEMPORAL_RANGE", "val": "Last week"},
+            {"col": "unidade", "op": "IN", "val": [company]}
+        ]
+
+    @staticmethod
+    async def get_chart(client, chart_id, url):
+        chart_resp = await client.get(f"{url}/api/v1/chart/{chart_id}")
+        chart_data = orjson.loads(chart_resp.content)["result"]
+        params = orjson.loads(chart_data["params"])
+        query_context = orjson.loads(chart_data["query_context"])
+        return params, chart_data, query_context
+
+    def add_filter(self, chart_filter):
+        return [f for f in chart_filter if f['subject'] not in REPLACED_FILTER_SUBJECTS] + self.extra_filters
+
+    def build_query_context(self, query_context, params):
+        query_context["form_data"] = params
+        for query in query_context["queries"]:
+            query["filters"] = [f for f in query.get("filters", [])
+                                if not isinstance(f['col'], str) or f['col'] not in REPLACED_FILTER_SUBJECTS]
+            query["filters"] += self.query_filters
+        return query_context
 
     @staticmethod
-    def update_chart(chart_id, params, chart_data, headers, url):
+    async def update_chart(client, chart_id, params, chart_data, query_context, url):
         update_payload = {
             "slice_name": chart_data["slice_name"],
             "viz_type": chart_data["viz_type"],
             "datasource_type": "table",
-            "datasource_id": json.loads(chart_data["query_context"])["datasource"]["id"],
-            "params": json.dumps(params)
+            "datasource_id": query_context["datasource"]["id"],
+            "params": orjson.dumps(params).decode()
         }
-        pprint(update_payload)
-        put_resp = requests.put(f"{url}/api/v1/chart/{chart_id}", headers={**headers,
-                                                                           "Content-Type": "application/json"},
-                                json=update_payload)
-        if put_resp.status_code == 200:
-            put_resp.json()
-        else:
+        logger.debug("Atualizando gráfico %s: %s", chart_id, update_payload)
+        put_resp = await client.put(f"{url}/api/v1/chart/{chart_id}", content=orjson.dumps(update_payload),
+                                    headers={"Content-Type": "application/json"})
+        if put_resp.status_code != 200:
             raise Exception(f"Error: {put_resp.status_code}: {put_resp.text}")
 
-    def run(self):
-        headers = self.get_auth_token(url=self.base_url, username=self.username, password=self.password)
-        for chart_id in self.charts:
-            params, chart_data, query_context = self.get_chart(chart_id=chart_id, headers=headers, url=self.base_url)
-            new_filter = self.add_filter(chart_filter=params["adhoc_filters"], company=self.company)
-            params["adhoc_filters"] = new_filter
-            self.update_chart(chart_id=chart_id,
-                              params=params,
-                              chart_data=chart_data,
-                              headers=headers,
-                              url=self.base_url)
+    async def update_one(self, client, chart_id):
+        params, chart_data, query_context = await self.get_chart(client=client, chart_id=chart_id,
+                                                                 url=self.base_url)
+        new_filter = self.add_filter(chart_filter=params["adhoc_filters"])
+        params["adhoc_filters"] = new_filter
+        await self.update_chart(client=client,
+                                chart_id=chart_id,
+                                params=params,
+                                chart_data=chart_data,
+                                query_context=query_context,
+                                url=self.base_url)
+        # query_context com o filtro da empresa fica só nesta execução, sem ser salvo no gráfico
+        return chart_id, {"viz_type": chart_data["viz_type"],
+                          "params": params,
+                          "query_context": self.build_query_context(query_context=query_context, params=params)}
+
+    async def run(self, client):
+        return dict(await asyncio.gather(*(self.update_one(client=client, chart_id=chart_id)
+                                           for chart_id in self.charts)))
+
+
+class BigNumberChart:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.chart_data_url = self.base_url + "/api/v1/chart/data"
 
+    @staticmethod
+    def supports(chart):
+        params = chart["params"]
+        return (chart["viz_type"] in RENDERED_VIZ_TYPES
+                and params.get("y_axis_format") in DEFAULT_NUMBER_FORMATS
+                and not params.get("subheader") and not params.get("subtitle"))
 
-class ScreenshotChart:
-    def __init__(self, base_url, username, password):
-        self.base_url = base_url
-        self.username = username
-        self.password = password
-        self.cache_screenshot_url = self.base_url + "/api/v1/chart/{id}/cache_screenshot/"
+    @staticmethod
+    async def get_value(client, chart_data_url, query_context):
+        payload = {**query_context, "result_format": "json", "result_type": "full"}
+        response = await client.post(chart_data_url, content=orjson.dumps(payload),
+                                     headers={"Content-Type": "application/json"})
+        if response.status_code != 200:
+            raise Exception(f"Error: {response.status_code}: {response.text}")
+        data = orjson.loads(response.content)["result"][0]["data"]
+        return next(iter(data[0].values())) if data else None
 
     @staticmethod
-    def get_auth_token(url, username, password):
-        login_resp = requests.post(f"{url}/api/v1/security/login", json={
-            "username": username,
-            "password": password,
-            "provider": "db"
-        })
-        access_token = login_resp.json()["access_token"]
-        return {"Authorization": f"Bearer {access_token}"}
+    def format_value(value):
+        # Mesmo resultado do formato SMART_NUMBER (padrão do Superset)
+        if value is None:
+            return "-"
+        if value == 0:
+            return "0"
+        absolute = abs(value)
+        if absolute >= 1000:
+            rounded = float(f"{value:.3g}")
+            factor, prefix = next((f, p) for f, p in SI_PREFIXES if abs(rounded) >= f)
+            return f"{rounded / factor:.3g}{prefix}"
+        decimals = 2 if absolute >= 1 else 4
+        return f"{value:.{decimals}f}".rstrip("0").rstrip(".")
 
     @staticmethod
-    def change_base_url(old_url, new_base_url):
-        parsed_old = urlparse(old_url)
-        parsed_new_base = urlparse(new_base_url)
+    def draw(text, output_path):
+        image = Image.new("RGB", BIG_NUMBER_SIZE, "white")
+        font = ImageFont.truetype(BIG_NUMBER_FONT, BIG_NUMBER_FONT_SIZE)
+        ImageDraw.Draw(image).text((BIG_NUMBER_SIZE[0] / 2, BIG_NUMBER_SIZE[1] / 2), text, font=font,
+                                   fill="black", anchor="mm")
+        image.save(output_path)
+
+    async def render_chart(self, client, query_context, name):
+        value = await self.get_value(client=client, chart_data_url=self.chart_data_url, query_context=query_context)
+        output_path = f"./data/img/{name}.png"
+        await asyncio.to_thread(self.draw, self.format_value(value), output_path)
+        print(f"Imagem salva em: {output_path}")
+
+    async def run(self, client, charts):
+        await asyncio.gather(*(self.render_chart(client=client, query_context=query_context, name=name)
+                               for name, query_context in charts.items()))
+
 
-        new_url = urlunparse((
-            parsed_new_base.scheme or parsed_old.scheme,
-            parsed_new_base.netloc or parsed_old.netloc,
+class ScreenshotChart:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        parsed_base = urlsplit(base_url)
+        self.base_scheme = parsed_base.scheme
+        self.base_netloc = parsed_base.netloc
+        self.cache_screenshot_url = self.base_url + "/api/v1/chart/{id}/cache_screenshot/"
+
+    def change_base_url(self, old_url):
+        parsed_old = urlsplit(old_url)
+
+        new_url = urlunsplit((
+            self.base_scheme or parsed_old.scheme,
+            self.base_netloc or parsed_old.netloc,
             parsed_old.path,
-            parsed_old.params,
             parsed_old.query,
             parsed_old.fragment
         ))
@@ -130,133 +277,114 @@ class ScreenshotChart:
         return new_url
 
     @staticmethod
-    def cache_screenshot(cache_screenshot_url, headers):
-        response = requests.get(cache_screenshot_url, headers=headers)
+    async def cache_screenshot(client, cache_screenshot_url):
+        response = await client.get(cache_screenshot_url)
         if response.status_code == 200 or response.status_code == 202:
-            data = response.json()["image_url"]
-            time.sleep(30)
-            return data
+            return response.json()["image_url"]
         else:
             raise Exception(f"Error: {response.status_code}: {response.text}")
 
     @staticmethod
-    def download_screenshot(url, headers, output_path):
-        response = requests.get(url, headers={**headers})
-        if response.status_code == 200:
+    async def wait_screenshot(client, url):
+        for delay in SCREENSHOT_POLL_DELAYS:
+            response = await client.head(url)
+            if response.status_code == 200:
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def download_screenshot(client, url, output_path):
+        async with client.stream("GET", url) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"Erro ao baixar imagem. Status: {response.status_code}, Detalhes: {response.text}")
             with open(output_path, 'wb') as f:
-                f.write(response.content)
-            print(f"Imagem salva em: {output_path}")
-        else:
-            raise Exception(f"Erro ao baixar imagem. Status: {response.status_code}, Detalhes: {response.text}")
+                async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+        print(f"Imagem salva em: {output_path}")
 
-    def run(self, chart_id, name):
+    async def screenshot_chart(self, client, chart_id, name):
         chart_cache_screenshot_url = self.cache_screenshot_url.format(id=chart_id)
-        headers = self.get_auth_token(url=self.base_url, username=self.username, password=self.password)
-        image_url = self.cache_screenshot(cache_screenshot_url=chart_cache_screenshot_url, headers=headers)
-        new_image_url = self.change_base_url(old_url=image_url, new_base_url=self.base_url)
-        self.download_screenshot(url=new_image_url, headers=headers, output_path=f"./data/img/{name}.png")
+        image_url = await self.cache_screenshot(client=client, cache_screenshot_url=chart_cache_screenshot_url)
+        new_image_url = self.change_base_url(old_url=image_url)
+        await self.wait_screenshot(client=client, url=new_image_url)
+        await self.download_screenshot(client=client, url=new_image_url, output_path=f"./data/img/{name}.png")
 
+    async def run(self, client, charts):
+        await asyncio.gather(*(self.screenshot_chart(client=client, chart_id=chart_id, name=name)
+                               for name, chart_id in charts.items()))
+
+
+async def refresh_charts(base_url, headers, company, charts):
+    async with httpx.AsyncClient(http2=True, headers=headers, timeout=SUPERSET_TIMEOUT,
+                                 limits=httpx.Limits(max_connections=SUPERSET_POOL_SIZE)) as client:
+        updated = await UpdateChart(base_url, charts.values(), company).run(client)
+        rendered = {name: updated[chart_id]["query_context"] for name, chart_id in charts.items()
+                    if BigNumberChart.supports(updated[chart_id])}
+        screenshots = {name: chart_id for name, chart_id in charts.items() if name not in rendered}
+        await asyncio.gather(BigNumberChart(base_url).run(client, rendered),
+                             ScreenshotChart(base_url).run(client, screenshots))
 
-def generate_report_pipe(company, start_date, end_date, report_name):
-    BASE_URL = "http://superset:8088"
-    USERNAME = os.getenv('SUPERSET_USERNAME')
-    PASSWORD = os.getenv('SUPERSET_PASSWORD')
 
-    charts_mapping = {
-        'total_vencidos': 8,
-        'total_visitas': 9,
-        'total_nao_conformidades': 10,
-        'media_nota': 11,
-        'conformidade_por_unidade': 12,
-        'media_nota_por_unidade': 13,
-        'porcentagem_conformidade': 14,
-        'conformidade_por_area': 15,
-        'itens_nao_conformes': 16,
-        'vencidor_por_loja': 17
+def update_report_charts(company):
+    headers = get_auth_token(url=SUPERSET_URL, username=os.getenv('SUPERSET_USERNAME'),
+                             password=os.getenv('SUPERSET_PASSWORD'))
 
-    }
+    asyncio.run(refresh_charts(SUPERSET_URL, headers, company, CHARTS_MAPPING))
 
-    chart_ids = charts_mapping.values()
 
-    UpdateChart(BASE_URL, USERNAME, PASSWORD, chart_ids, company).run()
+def sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
 
-    for k, chart_id in charts_mapping.items():
-        ScreenshotChart(BASE_URL, USERNAME, PASSWORD).run(chart_id=chart_id, name=k)
 
-    duckdb.sql(f"""
-    CREATE OR REPLACE PERSISTENT SECRET my_secret (
+@lru_cache(maxsize=1)
+def get_duckdb_connection():
+    con = duckdb.connect()
+    con.execute(f"""
+    CREATE OR REPLACE SECRET my_secret (
     TYPE S3,
     REGION 'us-east-1',
-    KEY_ID '{os.getenv("MINIO_ACCESS_KEY")}',
-    SECRET '{os.getenv("MINIO_SECRET_KEY")}',
-    ENDPOINT '{os.getenv("MINIO_ENDPOINT").replace('http://', '')}',
+    KEY_ID {sql_literal(os.getenv("MINIO_ACCESS_KEY"))},
+    SECRET {sql_literal(os.getenv("MINIO_SECRET_KEY"))},
+    ENDPOINT {sql_literal(os.getenv("MINIO_ENDPOINT").replace('http://', ''))},
     USE_SSL 'false',
     URL_STYLE 'path');
     """)
+    return con
 
-    text = duckdb.sql(f"""
-    SELECT DISTINCT final_comments
-    FROM 's3://hawkeye/lm/cleaned/checklist.parquet'
-    WHERE unidade = '{company}' and data_inicial BETWEEN '{str(start_date)}' AND '{str(end_date)}'
-    ORDER BY data_inicial DESC
-    """).df().to_markdown()
-
-    max_chars = 28_000 * 4
-
-    if len(text) > max_chars:
-        print(f"[INFO] Texto truncado de {len(text)} para {max_chars} caracteres.")
-        text = text[:max_chars]
-
-    template = f'''
-    You are a food safety and data analyst specialist to LM food safety consultant.
-    LM Segurança Alimentar is a brazilian company that give consultant to restaurants and supermarkets about food safety.
-    It conducts monitoring, audits, and training to ensure that products are stored, handled, and displayed in accordance
-    with health regulations. In addition, it verifies temperatures, expiration dates, and the hygiene of equipment
-    and employees, preventing contamination and reducing health risks to consumers.
-    Your task is to analyse previous visits to establishments and give summarized version to the client.
-
-    # Instructions:
-    1. Synthesize key findings into a cohesive narrative (max 100 words)
-    2. Highlight recurring issues or patterns across visits
-    3. Write in paragraph format only - no lists or bullet points
-    4. Use Brazilian Portuguese (pt-BR)
-    5. Focus on actionable insights: non-compliances, critical temperature deviations, hygiene issues, and expired products
-    6. Do not add conclusions, recommendations, or extra commentary beyond the data summary
-
-    # Guardrails:
-    - ONLY analyze data provided in the Visit Data section below
-    - DO NOT invent, assume, or extrapolate information not present in the data
-    - Maintain professional, neutral tone - avoid alarmist or dismissive language
 
-    # Visit Date Range:
-    Start date: {{start_date}}
-    End date: {{end_date}}
-    
-    # Visit Data:
-    {{dataframe}}
+def summarize_visits(company, start_date, end_date):
+    comments = get_duckdb_connection().cursor().execute("""
+    SELECT final_comments
+    FROM 's3://hawkeye/lm/cleaned/checklist.parquet'
+    WHERE unidade = ? and data_inicial BETWEEN ? AND ? AND final_comments IS NOT NULL
+    GROUP BY final_comments
+    ORDER BY max(data_inicial) DESC
+    LIMIT ?
+    """, [company, str(start_date), str(end_date), COMMENTS_LIMIT]).fetchall()
 
-    Output the summary in pt-BR as a single paragraph.
-    '''
+    text = "\n".join(row[0] for row in comments)[:PROMPT_MAX_CHARS]
 
     client = OpenAI(
         api_key=os.getenv("OPENAI_API_KEY"))
     response = client.chat.completions.create(
         model='gpt-4o',
         messages=[
-            {"role": "user", "content": template.format(dataframe=text,
-                                                        start_date=str(start_date), end_date=str(end_date))},
+            {"role": "user", "content": PROMPT_TEMPLATE.format(dataframe=text,
+                                                               start_date=str(start_date), end_date=str(end_date))},
         ],
         temperature=0.2
     )
+    return response.choices[0].message.content
+
 
-    generate_report_pdf(output_path='report.pdf', name=company, text=response.choices[0].message.content,
+def publish_report(company, summary, start_date, end_date, report_name):
+    generate_report_pdf(output_path='report.pdf', name=company, text=summary,
                         start_date=start_date, end_date=end_date)
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=os.getenv('MINIO_ENDPOINT'),
-        aws_access_key_id=os.getenv('MINIO_ACCESS_KEY'),
-        aws_secret_access_key=os.getenv('MINIO_SECRET_KEY'),
-        region_name="us-east-1",
-    )
+    upload_files(get_s3_client(), {'report.pdf': f'lm/reports/{report_name}'}, os.getenv('MINIO_BUCKET'))
+
 
-    s3.upload_file('report.pdf', os.getenv('MINIO_BUCKET'), f'lm/reports/{report_name}')
+def generate_report_pipe(company, start_date, end_date, report_name):
+    update_report_charts(company)
+    summary = summarize_visits(company, start_date, end_date)
+    publish_report(company, summary, start_date, end_date, report_name)